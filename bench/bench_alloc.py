@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+"""
+地址分配微基准：对比逐个地址对象的generate_addr_v2/generate_user与整数批量分配器AddrAllocator
+
+用法: python3 bench/bench_alloc.py [-c 次数]
+"""
+import os
+import sys
+import time
+import argparse
+import ipaddress
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cfgnet  # noqa: E402
+
+
+def make_plan(network, count_exclude, manual=None):
+    network = ipaddress.ip_network(network)
+    gateway = network.network_address + 1
+    exclude = [(int(gateway), int(gateway)),
+               (int(network.network_address), int(network.network_address)),
+               (int(network.broadcast_address), int(network.broadcast_address))]
+    # 每隔97个地址排除一个，模拟-F提供的大量排除地址
+    base = int(network.network_address)
+    for i in range(count_exclude):
+        exclude.append((base + 10 + i * 97, base + 10 + i * 97))
+    return {
+        'network': network,
+        'gateway': gateway,
+        'starting_addr': None,
+        'manual_addr_parsed': ipaddress.ip_address(manual) if manual else None,
+        'base_num': 1,
+        'exclude': cfgnet.compile_exclude(exclude),
+    }
+
+
+def run_generator(plan, hosts):
+    gen = cfgnet.generate_user(plan) if plan['manual_addr_parsed'] else cfgnet.generate_addr_v2(plan)
+    out = []
+    for _ in range(hosts):
+        addr = next(gen)
+        if addr is None:
+            break
+        out.append(str(addr))
+    return out
+
+
+def run_allocator(plan, hosts):
+    allocator = cfgnet.AddrAllocator(plan)
+    out = []
+    while len(out) < hosts:
+        batch = allocator.allocate(min(cfgnet.ALLOC_BATCH, hosts - len(out)))
+        if not batch:
+            break
+        out.extend(str(allocator.to_address(v)) for v in batch)
+    return out
+
+
+def run_allocator_int(plan, hosts):
+    return cfgnet.AddrAllocator(plan).allocate(hosts)
+
+
+def bench(name, func, plan, hosts, count):
+    best = None
+    for _ in range(count):
+        begin = time.perf_counter()
+        func(plan, hosts)
+        spent = time.perf_counter() - begin
+        best = spent if best is None else min(best, spent)
+    print("{:<28} {:>8} hosts  {:>9.1f} ms  {:>10.0f} addr/s".format(name, hosts, best * 1000, hosts / best))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='地址分配微基准')
+    parser.add_argument('-c', '--count', type=int, default=3, help='每项重复次数，取最好成绩')
+    args = parser.parse_args()
+    cases = [
+        ('/16 v4', '10.20.0.0/16', 60000, 600),
+        ('/48 v6', '2001:db8:1::/48', 100000, 2000),
+    ]
+    for title, network, hosts, count_exclude in cases:
+        plan = make_plan(network, count_exclude)
+        assert run_generator(plan, hosts) == run_allocator(plan, hosts)
+        print("# {} ({} exclusions)".format(title, count_exclude))
+        bench('generate_addr_v2', run_generator, plan, hosts, args.count)
+        bench('AddrAllocator (+str)', run_allocator, plan, hosts, args.count)
+        bench('AddrAllocator (int only)', run_allocator_int, plan, hosts, args.count)
+
+
+if __name__ == "__main__":
+    main()
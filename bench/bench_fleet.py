@@ -0,0 +1,326 @@
+#!/usr/bin/python3
+"""
+吞吐量基准：在本进程内启动一个asyncssh服务端模拟整批主机，通过真实的run()/work()/do_remote_job路径执行配置任务
+
+- 服务端监听在一个随机端口上，每台虚拟主机使用一个127.0.0.0/8中的回环地址，只接受来自回环地址的连接
+- 模拟ip route get、nmcli device connect/reapply、nmcli connection modify/reload/up、nmcli -t -f读取配置(--diff)、
+  nmcli -g GENERAL.DEVICES、uptime、ip -o addr show以及--oneshot的脚本，虚拟主机的连接初始为已激活
+- 指定的连接UUID不是FAKE_UUID时按nmcli的方式报告unknown connection，用于模拟--facts-cache中失效的UUID
+- 可以设置每条命令的延迟、失败率(不作用于--oneshot脚本)和握手延迟
+- 每个(主机数, 并发数)组合在单独的子进程中运行，输出hosts/sec、p99耗时和峰值RSS
+- 每个主机数再用cfgnet的默认设置(不指定-C和--conn-max)运行一次，这时cfgnet进程的RLIMIT_NOFILE软限制为--nofile，
+  模拟的服务端在另一个进程中运行，不占用cfgnet的文件描述符
+- --check-auth：虚拟主机全部拒绝认证，检查PermissionDenied不会被--retries重试，有重试时退出码为1
+
+用法: python3 bench/bench_fleet.py [--hosts 100,1000,10000] [-C 8,32,128] [--cmd-latency 0.02] [--oneshot] [--nofile 1024]
+      python3 bench/bench_fleet.py --check-auth
+"""
+import os
+import re
+import sys
+import json
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import ipaddress
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import asyncssh  # noqa: E402
+import cfgnet  # noqa: E402
+
+FAKE_UUID = '5f1e1a2b-1111-2222-3333-444455556666'
+FAKE_ROUTE = '8.8.8.8 via 10.0.0.1 dev eth0 src {} uid 0\n    cache\n'
+# --oneshot脚本在本地的/bin/sh中执行，ip和nmcli用shell函数模拟
+FAKE_SHELL = r"""ip() { sleep {latency}; echo "8.8.8.8 via 10.0.0.1 dev eth0 src 10.0.0.9 uid 0"; }
+nmcli() {
+    sleep {latency}
+    case "$1 $2" in
+    "device connect") echo "Device '$3' successfully activated with '{uuid}'.";;
+    "-g GENERAL.DEVICES") echo eth0;;
+    *) echo "$*";;
+    esac
+}
+"""
+
+
+def virtual_host(index):
+    """第index台虚拟主机的回环地址，从127.10.0.1开始，跳过.0和.255"""
+    return str(ipaddress.ip_address('127.10.0.0') + (index // 254) * 256 + index % 254 + 1)
+
+
+class FakeServer(asyncssh.SSHServer):
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+
+    def connection_made(self, conn):
+        peer = conn.get_extra_info('peername')[0]
+        if not ipaddress.ip_address(peer).is_loopback:
+            conn.close()
+
+    async def begin_auth(self, username):
+        if self.fleet.handshake_delay:
+            await asyncio.sleep(self.fleet.handshake_delay)
+        return self.fleet.reject_auth  # 需要认证时没有可用的认证方式，客户端得到PermissionDenied
+
+
+class FakeFleet(object):
+
+    def __init__(self, cmd_latency=0.0, fail_rate=0.0, handshake_delay=0.0, reject_auth=False):
+        self.cmd_latency = cmd_latency
+        self.fail_rate = fail_rate
+        self.handshake_delay = handshake_delay
+        self.reject_auth = reject_auth
+        self.addresses = {}  # 虚拟主机 -> 已配置的地址
+        self.settings = {}  # 虚拟主机 -> {'gateway': 网关, 'dns': [DNS, ...], 'active': 是否已激活}
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        key = asyncssh.generate_private_key('ssh-ed25519')
+        self.server = await asyncssh.create_server(lambda: FakeServer(self), '0.0.0.0', 0, server_host_keys=[key],
+                                                   process_factory=self.handle, reuse_address=True)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, process):
+        host = process.channel.get_extra_info('sockname')[0]
+        cmd = process.command or ''
+        if cmd == '/bin/sh -s':
+            await self.run_script(process)
+            return
+        if self.cmd_latency:
+            await asyncio.sleep(self.cmd_latency)
+        if self.fail_rate and random.random() < self.fail_rate:
+            process.stderr.write('emulated failure: {}\n'.format(cmd))
+            process.exit(1)
+            return
+        uuid = re.search(r'connection (?:modify|up|show) "([0-9a-f-]{36})"', cmd)
+        if uuid is not None and uuid.group(1) != FAKE_UUID:
+            process.stderr.write("Error: unknown connection '{}'.\n".format(uuid.group(1)))
+            process.exit(10)
+            return
+        if cmd.startswith('ip route get'):
+            process.stdout.write(FAKE_ROUTE.format(host))
+        elif cmd.startswith('nmcli device connect'):
+            process.stdout.write("Device 'eth0' successfully activated with '{}'.\n".format(FAKE_UUID))
+        elif cmd.startswith('nmcli connection modify'):
+            self.modify(host, cmd)
+        elif cmd.startswith('nmcli connection up'):
+            self.settings.setdefault(host, {})['active'] = True
+        elif cmd.startswith('nmcli device reapply'):
+            if not self.settings.get(host, {}).get('active', True):
+                process.stderr.write("Error: Reapplying connection to device 'eth0' failed: device is not activated\n")
+                process.exit(1)
+                return
+        elif cmd.startswith('nmcli -t -f') or cmd.startswith('nmcli -g'):
+            process.stdout.write(self.show(host, cmd.split()[3 if cmd.startswith('nmcli -t') else 2].split(','),
+                                           cmd.startswith('nmcli -t')))
+        elif cmd.startswith('ip -o addr show'):
+            for index, addr in enumerate(sorted(self.addresses.get(host, ()))):
+                family = 'inet6' if ':' in addr else 'inet'
+                process.stdout.write('2: eth0    {} {} scope global\n'.format(family, addr))
+        elif cmd.startswith('uptime'):
+            process.stdout.write(' 10:00:00 up 1 day,  1 user,  load average: 0.00, 0.00, 0.00\n')
+        process.exit(0)
+
+    def modify(self, host, cmd):
+        settings = self.settings.setdefault(host, {})
+        for action, name, value in re.findall(r'([+-]?)ipv[46]\.(addresses|gateway|dns) "([^"]*)"', cmd):
+            if name == 'gateway':
+                settings['gateway'] = '' if action == '-' else value
+                continue
+            current = self.addresses.setdefault(host, set()) if name == 'addresses' else settings.setdefault('dns', [])
+            if action == '':
+                current.clear()
+            for item in re.split(r'[,\s]+', value.strip()):
+                if name == 'addresses':
+                    (current.discard if action == '-' else current.add)(item)
+                elif action == '-':
+                    if item in current:
+                        current.remove(item)
+                elif item not in current:
+                    current.append(item)
+
+    def show(self, host, fields, names=True):
+        """模拟nmcli -t -f(names为True)或-g ... connection show的输出，值中的冒号按nmcli的方式转义"""
+        settings = self.settings.get(host, {})
+        lines = []
+        for field in fields:
+            name = field.split('.')[-1]
+            if name == 'method':
+                value = 'manual' if settings else 'auto'
+            elif name == 'addresses':
+                value = ','.join(sorted(self.addresses.get(host, ())))
+            elif name == 'gateway':
+                value = settings.get('gateway', '')
+            elif name == 'dns':
+                value = ','.join(settings.get('dns', []))
+            elif name in ('STATE', 'DEVICES'):
+                if not settings.get('active', True):
+                    continue
+                value = 'activated' if name == 'STATE' else 'eth0'
+            else:
+                value = ''
+            value = value.replace(':', '\\:')
+            lines.append('{}:{}\n'.format(field, value) if names else value + '\n')
+        return ''.join(lines)
+
+    async def run_script(self, process):
+        script = await process.stdin.read()
+        prelude = FAKE_SHELL.replace('{latency}', str(self.cmd_latency)).replace('{uuid}', FAKE_UUID)
+        proc = await asyncio.create_subprocess_exec('/bin/sh', '-s', stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                    stderr=subprocess.PIPE)
+        stdout, stderr = await proc.communicate((prelude + script).encode())
+        process.stdout.write(stdout.decode())
+        process.stderr.write(stderr.decode())
+        process.exit(proc.returncode)
+
+
+class RemoteFleet(object):
+    """在--serve子进程中运行的FakeFleet，接口与FakeFleet的start/close/port一致"""
+
+    def __init__(self, args):
+        self.args = args
+        self.proc = None
+        self.port = None
+
+    async def start(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), '--serve', '--cmd-latency', str(self.args.cmd_latency),
+            '--fail-rate', str(self.args.fail_rate), '--handshake-delay', str(self.args.handshake_delay),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.port = int(await self.proc.stdout.readline())
+
+    async def close(self):
+        self.proc.stdin.close()
+        await self.proc.wait()
+
+
+async def serve(args):
+    """--serve：输出端口号，标准输入关闭后退出"""
+    fleet = FakeFleet(args.cmd_latency, args.fail_rate, args.handshake_delay)
+    await fleet.start()
+    print(fleet.port, flush=True)
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.read)
+    await fleet.close()
+
+
+async def run_single(args):
+    if args.defaults:
+        fleet = RemoteFleet(args)
+    else:
+        fleet = FakeFleet(args.cmd_latency, args.fail_rate, args.handshake_delay, args.check_auth)
+    await fleet.start()
+    with tempfile.TemporaryDirectory(prefix='cfgnet-bench-') as workdir:
+        pool_file = os.path.join(workdir, 'pool')
+        stats_file = os.path.join(workdir, 'stats.json')
+        with open(pool_file, mode='w', encoding='utf8') as fd:
+            for index in range(args.hosts):
+                fd.write('{}:{}\n'.format(virtual_host(index), fleet.port))
+        argv = ['cfgnet', '-p', pool_file, '-n', '10.0.0.0/8', '--no-agent', '--stats-json', stats_file]
+        if args.check_auth:
+            argv += ['--retries', '3', '--retry-backoff', '0.01']
+        if not args.defaults:
+            argv += ['-C', args.concurrency, '--conn-max', str(args.conn_max)]
+        argv += args.extra
+        if args.oneshot:
+            argv.append('--oneshot')
+        sys.argv = argv
+        params_parsed = cfgnet.parsed_params(cfgnet.parse_argument())
+        try:
+            await cfgnet.run(params_parsed)
+        finally:
+            await fleet.close()
+        with open(stats_file, encoding='utf8') as fd:
+            summary = json.load(fd)['summary']
+    apply = summary['results'].get('apply', {'ok': 0, 'failed': 0})
+    return {
+        'hosts': args.hosts,
+        'concurrency': args.concurrency,
+        'hosts_per_sec': summary['hosts_per_sec'],
+        'p99': summary['phases'].get('total', {}).get('p99', 0.0),
+        'ok': apply['ok'],
+        'failed': apply['failed'],
+        'retries': summary['retries'],
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cfgnet虚拟主机吞吐量基准')
+    parser.add_argument('--hosts', type=str, default='100,1000,10000', help='虚拟主机数，以英文逗号分隔')
+    parser.add_argument('-C', '--concurrency', type=str, default='8,32,128', help='并发数，以英文逗号分隔，可以包含auto')
+    parser.add_argument('--cmd-latency', type=float, default=0.02, help='每条远程命令的模拟延迟(秒)')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='每条远程命令的模拟失败率(0-1)')
+    parser.add_argument('--handshake-delay', type=float, default=0.0, help='SSH握手的模拟延迟(秒)')
+    parser.add_argument('--conn-max', type=int, default=512, help='传给cfgnet的--conn-max')
+    parser.add_argument('--oneshot', action='store_true', default=False, help='使用--oneshot模式')
+    parser.add_argument('--nofile', type=int, default=1024, help='默认设置的运行中cfgnet进程的RLIMIT_NOFILE软限制')
+    parser.add_argument('--check-auth', action='store_true', default=False,
+                        help='只检查认证失败(PermissionDenied)不会被--retries重试')
+    parser.add_argument('--single', action='store_true', default=False, help=argparse.SUPPRESS)
+    parser.add_argument('--defaults', action='store_true', default=False, help=argparse.SUPPRESS)
+    parser.add_argument('--serve', action='store_true', default=False, help=argparse.SUPPRESS)
+    parser.add_argument('extra', nargs='*', help='直接传给cfgnet的其它参数(放在--之后)')
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if args.single and args.defaults:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(args.nofile, hard), hard))
+    else:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    if args.serve:
+        asyncio.run(serve(args))
+        return
+    if args.single:
+        args.hosts = int(args.hosts)
+        logging.getLogger().setLevel(logging.ERROR)
+        print(json.dumps(asyncio.run(run_single(args))))
+        return
+
+    if args.check_auth:
+        hosts = args.hosts.split(',')[0]
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--single', '--check-auth', '--hosts', hosts,
+                               '-C', args.concurrency.split(',')[0]], stdout=subprocess.PIPE, universal_newlines=True)
+        result = json.loads(proc.stdout.strip().splitlines()[-1]) if proc.returncode == 0 else None
+        if result is None or result['retries'] or result['ok']:
+            print("auth check failed: {}".format(result or 'exit code {}'.format(proc.returncode)))
+            sys.exit(1)
+        print("auth check ok: {} hosts rejected, {} retries".format(result['failed'], result['retries']))
+        return
+
+    print("{:>8}{:>8}{:>12}{:>10}{:>8}{:>8}{:>10}".format('hosts', '-C', 'hosts/sec', 'p99(s)', 'ok', 'failed',
+                                                          'rss(MB)'))
+    for hosts in args.hosts.split(','):
+        for concurrency in args.concurrency.split(',') + ['default']:
+            cmd = [sys.executable, os.path.abspath(__file__), '--single', '--hosts', hosts, '-C', concurrency,
+                   '--cmd-latency', str(args.cmd_latency), '--fail-rate', str(args.fail_rate),
+                   '--handshake-delay', str(args.handshake_delay), '--conn-max', str(args.conn_max),
+                   '--nofile', str(args.nofile)]
+            if concurrency == 'default':
+                cmd.append('--defaults')
+            if args.oneshot:
+                cmd.append('--oneshot')
+            if args.extra:
+                cmd += ['--'] + args.extra
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+            if proc.returncode != 0:
+                print("{:>8}{:>8}  failed with exit code {}".format(hosts, concurrency, proc.returncode))
+                continue
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            print("{:>8}{:>8}{:>12.1f}{:>10.3f}{:>8}{:>8}{:>10.1f}".format(
+                result['hosts'], result['concurrency'], result['hosts_per_sec'], result['p99'], result['ok'],
+                result['failed'], result['peak_rss_mb']))
+
+
+if __name__ == "__main__":
+    main()
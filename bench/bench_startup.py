@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+"""
+启动耗时基准：用python -X importtime检查不需要SSH的模式(--help、example、-I、-S)是否导入了重量级模块，并统计启动耗时
+
+- 每种模式先运行一次，解析-X importtime的输出，导入了FORBIDDEN中的模块时视为回归
+- 再运行--runs次取中位数，输出整个进程的耗时和模块导入总耗时
+- 指定--max-ms时，导入总耗时的中位数超过该值也视为回归
+- 有回归时退出码为1，可以放在CI中使用
+
+用法: python3 bench/bench_startup.py [--runs 10] [--max-ms 80]
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+CFGNET = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cfgnet.py')
+FORBIDDEN = ('asyncssh', 'asyncio', 'termcolor', 'cryptography', 'multiprocessing', 'concurrent.futures', 'pprint')
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)$')
+
+
+def parse_importtime(stderr):
+    """返回(导入的模块集合, 顶层模块的累计导入耗时，单位毫秒)"""
+    modules = set()
+    total = 0
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match is None:
+            continue
+        modules.add(match.group(4))
+        if len(match.group(3)) == 1:  # 名称前只有一个空格的是顶层导入
+            total += int(match.group(2))
+    return modules, total / 1000.0
+
+
+def matches(name, packages):
+    return any(name == package or name.startswith(package + '.') for package in packages)
+
+
+def run_mode(argv, allowed=()):
+    begin = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + argv, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = (time.perf_counter() - begin) * 1000.0
+    modules, import_ms = parse_importtime(proc.stderr)
+    loaded = [package for package in FORBIDDEN
+              if package not in allowed and any(matches(name, (package,)) for name in modules)]
+    return proc.returncode, elapsed, import_ms, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cfgnet启动耗时基准')
+    parser.add_argument('--runs', type=int, default=10, help='每种模式运行的次数')
+    parser.add_argument('--hosts', type=int, default=1000, help='-I使用的地址池中的主机数')
+    parser.add_argument('--max-ms', type=float, default=0, help='模块导入总耗时的上限(毫秒)，默认不检查')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='cfgnet-bench-') as workdir:
+        pool_file = os.path.join(workdir, 'pool')
+        with open(pool_file, mode='w', encoding='utf8') as fd:
+            for index in range(args.hosts):
+                fd.write('10.{}.{}.{}\n'.format(index >> 16 & 255, index >> 8 & 255, index & 255))
+        log_file = os.path.join(workdir, 'log')
+        with open(log_file, mode='w', encoding='utf8') as fd:
+            for index in range(args.hosts):
+                fd.write('conn from 192.168.{}.{} to fd00::{:x} ok\n'.format(index >> 8 & 255, index & 255, index))
+        modes = [
+            ('import', ['-c', 'import sys; sys.path.insert(0, {!r}); import cfgnet'.format(os.path.dirname(CFGNET))],
+             ()),
+            ('--help', [CFGNET, '--help'], ()),
+            ('example', [CFGNET, 'example'], ('termcolor',)),
+            ('-I', [CFGNET, '-p', pool_file, '-n', '10.200.0.0/16', '-I'], ()),
+            ('-S', [CFGNET, '-S', log_file], ()),
+        ]
+
+        failed = False
+        print("{:<10}{:>12}{:>12}  {}".format('mode', 'wall(ms)', 'import(ms)', 'heavy modules'))
+        for name, argv, allowed in modes:
+            returncode, _, _, loaded = run_mode(argv, allowed)
+            walls = []
+            imports = []
+            for _ in range(args.runs):
+                _, elapsed, import_ms, _ = run_mode(argv, allowed)
+                walls.append(elapsed)
+                imports.append(import_ms)
+            wall = statistics.median(walls)
+            import_ms = statistics.median(imports)
+            problems = []
+            if returncode != 0:
+                problems.append('exit code {}'.format(returncode))
+            if loaded:
+                problems.append(', '.join(loaded))
+            if args.max_ms and import_ms > args.max_ms:
+                problems.append('import {:.1f}ms > {:.1f}ms'.format(import_ms, args.max_ms))
+            failed = failed or bool(problems)
+            print("{:<10}{:>12.1f}{:>12.1f}  {}".format(name, wall, import_ms, '; '.join(problems) or '-'))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
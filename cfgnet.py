@@ -1,19 +1,43 @@
 #!/usr/bin/python3
+import os
 import sys
 import re
+import shlex
+import base64
+import bisect
+import itertools
+import collections
+import time
+import random
+import csv
+import json
+import heapq
+import math
+import array
+import mmap
+import socket
 import argparse
 import ipaddress
 import logging
-import asyncio
-import getpass
-from pprint import pprint
-from pickletools import uint8
-import asyncssh
-from termcolor import colored
-from atomic import AtomicLong
+import signal
+
+# asyncio和asyncssh由import_ssh()在需要建立SSH连接时导入，-S、-I、example和--help不加载它们
+asyncio = None
+asyncssh = None
+TimingClient = None
 
 tmpl_address = "8.8.8.8"
+DEFAULT_KEY_FILES = ('id_ed25519_sk', 'id_ecdsa_sk', 'id_ed448', 'id_ed25519', 'id_ecdsa', 'id_rsa', 'id_dsa')
 DEBUG = False
+ALLOC_BATCH = 4096  # 每次从分配器批量取出的地址数量
+SORT_CHUNK = 8 << 20  # -S每次扫描的块大小
+# 压缩形式(::)的IPv6也作为候选，是否合法由inet_pton判断
+SORT_PATTERN = re.compile(
+    rb"(?<![:.\w])((?:[a-f0-9]{0,4}:){2,7}[a-f0-9]{0,4})(?![:.\w])|(?<![.\d])((?:\d{1,3}\.){3}\d{1,3})(?![.\d])",
+    re.I)
+# 可能影响匹配结果的字节(地址本身和前后断言检查的字符)，分块时只在其它字节处切分
+SORT_CONTEXT = frozenset(b'0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_:.')
+CONN_RESERVED_FDS = 64  # 默认的--conn-max为结果文件、日志、ssh-agent等保留的文件描述符数
 
 logging.basicConfig(level=logging.WARNING,
                     format='%(message)s',
@@ -26,7 +50,36 @@ __version__ = "0.0.1"
 #     format='%(asctime)s [%(lineno)d] %(levelname)s # %(message)s',
 #     datefmt='%Y-%m-%d %M:%S')
 
+def import_ssh():
+    """导入建立SSH连接需要的asyncio和asyncssh，Python版本低于3.11或没有安装asyncssh时返回False"""
+    global asyncio, asyncssh, TimingClient
+    if sys.version_info < (3, 11):
+        # asyncio.TaskGroup、asyncio.timeout_at和asyncio.Runner从3.11开始提供，-S、-I和example不受影响
+        logging.error("建立SSH连接需要Python 3.11或更高版本，当前版本为%s" % sys.version.split()[0])
+        return False
+    import asyncio
+    try:
+        import asyncssh
+    except ImportError as e:
+        logging.error("需要安装asyncssh：%s" % e)
+        return False
+
+    class TimingClient(asyncssh.SSHClient):
+        """open_connection的client_factory：TCP连接建立时记录tcp阶段的耗时，之后的SSH握手和认证记为auth"""
+
+        def __init__(self, task, begin):
+            self.task = task
+            self.begin = begin
+
+        def connection_made(self, conn):
+            mark(self.task, 'tcp', self.begin)
+            self.task.step = 'auth'
+
+    return True
+
+
 def example():
+    from termcolor import colored
     print(colored('# 给文件hosts中的所有主机 (网关所在网络接口) 配置上地址,会覆盖旧的所有地址', 'blue'))
     print(colored(f'{sys.argv[0]} -p hosts -n 10.30.200.0/24', 'yellow'))
     print(colored('# 给文件hosts中的所有主机 (网关所在网络接口) 配置上地址和网关,会覆盖旧的所有地址', 'blue'))
@@ -62,10 +115,17 @@ def parse_argument():
                     '\033[41;37m在配置IP时，是否考虑加上--add参数，默认配置IP会覆盖原来的IP\033[0m',
         formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('-A', '--askpass', action='store_true', default=False, help="指定SSH密码")
+    parser.add_argument('-i', '--identity', action='append', default=[], metavar='filename',
+                        help="指定SSH私钥文件，可以多次指定，默认读取~/.ssh下的id_ed25519、id_ecdsa、id_rsa等私钥\n" +
+                             "私钥只在启动时读取一次，所有连接共用")
+    parser.add_argument('--known-hosts', type=str, default='', metavar='filename',
+                        help="指定known_hosts文件并开启主机密钥校验，默认不校验\n文件只在启动时解析一次")
+    parser.add_argument('--no-agent', action='store_true', default=False, help="不使用ssh-agent中的密钥")
     parser.add_argument('-u', '--user', type=str, default='', metavar='username',
                         help="指定SSH登录的用户名，当在-p指定的地址池中没有明确指定用户名时，使用此用户名")
     parser.add_argument('-p', '--pool', type=str, default='', metavar='filename',
-                        help='指定存地址池的文件名，一个IP一行，只支持v4\n格式：[user@]host[:port]\n默认端口号22,用户名为root')
+                        help='指定存地址池的文件名，每行一个IP、网段(10.0.0.0/22)或地址范围(10.0.1.5-10.0.1.200)，只支持v4\n'
+                             '格式：[user@]host[:port]\n默认端口号22,用户名为root，网段中不包括网络地址和广播地址')
     parser.add_argument('--desc', action='store_true', default=False,
                         help="降序（descending）排列由-A指定的地址池，默认是升序")
     parser.add_argument('--nsort', action='store_true', default=False, help="不排序由-A指定的地址池，默认是升序")
@@ -77,6 +137,14 @@ def parse_argument():
                         help='指定地址类型，4(=v4)或者6(=v6)，默认根据其它选项的内容进行推测')
     parser.add_argument('-n', '--network', type=str, default='', metavar='network_address',
                         help='指定IP的网段，地址类型必须和选定的类型一致')
+    parser.add_argument('--v6-assign', type=str, default='seq', choices=['seq', 'hash'],
+                        help='IPv6地址的分配方式，默认为seq\n' +
+                             'seq：从网关或起点地址开始按顺序分配，结果取决于地址池的顺序\n' +
+                             'hash：由主机管理地址(地址池中的IPv4)的稳定哈希得到接口标识，每台主机O(1)计算，\n' +
+                             '每次运行和各分片得到的地址都相同；与排除地址、网关或其它主机冲突时按固定规则重新选择')
+    parser.add_argument('--per-host', type=int, default=1, metavar='number',
+                        help='每台主机分配的地址数，默认为1\n' +
+                             '大于1时按顺序连续取出多个地址，在一条nmcli connection modify中一起配置，只激活一次')
     parser.add_argument('-g', '--gateway', type=str, default='', metavar='gateway_address',
                         help='指定IP的网关，地址类型必须和选定的类型一致')
     parser.add_argument('-s', '--start', type=str, default='', metavar='ipaddress',
@@ -89,21 +157,104 @@ def parse_argument():
                              '默认v6的DNS是：2001:4860:4860::8888,2001:4860:4860::8844\n' +
                              '阿里v6的DNS是：2400:3200::1,2400:3200:baba::1\n')
     parser.add_argument('-E', '--lexclude', type=str, default='', metavar='[ipaddress,...]',
-                        help='生成IP时，从中间排除的IP地址列表，以英文逗号分开')
+                        help='生成IP时，从中间排除的IP地址列表，以英文逗号分开\n' +
+                             '支持单个地址、网段(10.0.0.0/28)和地址范围(10.0.0.5-10.0.0.9)')
     parser.add_argument('-F', '--fexclude', type=str, default='', metavar='filename',
-                        help='生成IP时，从中间排除的IP地址列表\n从文件读取，一行一个IP')
+                        help='生成IP时，从中间排除的IP地址列表\n从文件读取，一行一个IP、网段或地址范围，#到行尾为注释')
     parser.add_argument('-e', '--eth', type=str, default='', metavar='eth_name', help="网卡设备名称")
     parser.add_argument('-c', '--cname', type=str, default='', metavar='nmcli_connection_name', help="nmcli的连接名称")
     parser.add_argument('--add', action='store_true', default=False, help="增加")
     parser.add_argument('--sub', action='store_true', default=False, help="减少")
-    parser.add_argument('--noup', action='store_true', default=False, help="不执行UP操作")
-    parser.add_argument('-C', '--concurrency', type=int, default=6, metavar='number', help="并发数，默认为6")
+    parser.add_argument('--noup', action='store_true', default=False, help="不执行UP操作，等同于--apply-strategy none")
+    parser.add_argument('--apply-strategy', type=str, default='', choices=['reload-up', 'reapply', 'none'],
+                        help="修改连接后让配置生效的方式，默认为reload-up\n" +
+                             "reload-up：nmcli connection reload后再nmcli connection up，重新激活整个连接\n" +
+                             "reapply：nmcli device reapply，在已激活的网卡上直接应用修改，不重读所有连接也不断开连接\n" +
+                             "none：只执行nmcli connection reload，不激活\n" +
+                             "每种方式的总耗时在性能报告中记录为apply-<方式>")
+    parser.add_argument('--oneshot', action='store_true', default=False,
+                        help="把发现网卡、修改、重载和激活合并为一个脚本，通过单个SSH通道一次执行完成")
+    parser.add_argument('--diff', action='store_true', default=False,
+                        help="修改前先用一条nmcli -t -f读取连接当前的地址、网关、DNS和激活状态\n" +
+                             "与要配置的内容一致的主机跳过modify、reload和up，结果报告为unchanged；只有未激活时只执行up\n" +
+                             "--oneshot时只有连接已知(-c或--facts-cache中有缓存)的主机才会先读取")
+    parser.add_argument('-C', '--concurrency', type=str, default='6', metavar='number|auto',
+                        help="并发数，默认为6\n" +
+                             "为auto时根据连接耗时、超时和连接被拒绝的情况在运行时自动调整并发数(AIMD)")
+    parser.add_argument('--workers', type=int, default=1, metavar='number',
+                        help="使用多个子进程执行，每个进程有自己的事件循环和连接池，默认为1\n" +
+                             "-C、--max-concurrency、--conn-max、--connect-rate和--connect-subnet-max为所有进程的总数，平均分给每个进程\n" +
+                             "结果由父进程统一汇总")
+    parser.add_argument('--shard', type=str, default='', metavar='i/N',
+                        help="把地址池按序号分成N份，只执行第i份(从1开始)，用于多台控制机分担同一批主机\n" +
+                             "每台控制机按完整的地址池分配地址，各分片分配到的地址不会重叠\n" +
+                             "分片和--resume一起使用时，需要把所有分片的日志合并后再使用")
+    parser.add_argument('--min-concurrency', type=int, default=2, metavar='number', help="-C auto时的最小并发数，默认为2")
+    parser.add_argument('--max-concurrency', type=int, default=256, metavar='number',
+                        help="-C auto时的最大并发数，默认为256")
     parser.add_argument('-I', '--ipaddr', action='store_true', default=False,
                         help="只显示生成的IP地址与地址池（-p）的对应列表\n## 并不执行任务 ##")
     parser.add_argument('-T', '--test', action='store_true', default=False,
                         help="尝试执行指定的简单的命令，并返回结果，并不会执行生成的配置任务")
+    parser.add_argument('--precheck', action='store_true', default=False,
+                        help="配置前先对所有主机执行-T的探测，只配置探测成功的主机")
+    parser.add_argument('--verify', action='store_true', default=False,
+                        help="配置完成后校验主机上的地址是否已经生效")
+    parser.add_argument('--conn-max', type=int, default=None, metavar='number',
+                        help="连接池同时打开的SSH连接数上限，0为不限制\n" +
+                             "默认为RLIMIT_NOFILE的软限制减去{}，--workers时每个进程按自己的限制计算\n".format(CONN_RESERVED_FDS) +
+                             "探测、配置和校验阶段共用连接，上限小于主机数时会关闭最久未用的连接")
+    parser.add_argument('--conn-idle', type=float, default=300, metavar='seconds',
+                        help="连接池中空闲连接的保留时间，默认300秒")
+    parser.add_argument('--connect-timeout', type=float, default=15, metavar='seconds',
+                        help="建立TCP连接和SSH握手的超时时间，默认15秒")
+    parser.add_argument('--cmd-timeout', type=float, default=30, metavar='seconds',
+                        help="ip route get、nmcli device connect/connection modify/reload、校验和-T等命令的超时时间，默认30秒")
+    parser.add_argument('--up-timeout', type=float, default=90, metavar='seconds',
+                        help="nmcli connection up、nmcli device reapply和--oneshot脚本的超时时间，默认90秒\n" +
+                             "以上超时时间为0时不限制，超时后关闭该命令的通道，按timeout失败处理，可以被--retries重试")
+    parser.add_argument('--deadline', type=float, default=0, metavar='seconds',
+                        help="整个运行(包括探测、配置、校验和重试)的截止时间，默认0为不限制\n" +
+                             "到达截止时间后取消仍在执行的主机，报告其所处的步骤；尚未开始的主机不再连接，直接按失败报告")
+    parser.add_argument('--retries', type=int, default=0, metavar='number',
+                        help="超时、连接被拒绝和通道打开失败时最多重试的次数，默认0为不重试\n" +
+                             "等待重试的主机不占用并发数，重试时使用原来分配的地址")
+    parser.add_argument('--retry-backoff', type=float, default=1.0, metavar='seconds',
+                        help="第一次重试前的等待时间，之后每次翻倍，最长30秒，实际等待时间在其一半到全部之间随机，默认1秒")
+    parser.add_argument('--connect-rate', type=float, default=0, metavar='number',
+                        help="每秒最多新建的SSH连接数，默认0为不限制\n" +
+                             "只限制新建连接，与并发数(-C)无关，复用连接池中的连接不受限制")
+    parser.add_argument('--connect-subnet-max', type=int, default=0, metavar='number',
+                        help="同一个网段中同时进行握手的连接数上限，默认0为不限制，网段大小由--connect-subnet-prefix指定")
+    parser.add_argument('--connect-subnet-prefix', type=int, default=24, metavar='number',
+                        help="--connect-subnet-max使用的网段掩码长度，默认为24")
+    parser.add_argument('--facts-cache', type=str, default='', metavar='filename',
+                        help="在本地文件中缓存每台主机的出口网卡和连接UUID，之后的运行不再执行ip route get和nmcli device connect\n" +
+                             "使用缓存配置失败时会重新发现并再执行一次")
+    parser.add_argument('--facts-ttl', type=float, default=86400, metavar='seconds',
+                        help="--facts-cache中记录的有效期，默认86400秒")
+    parser.add_argument('--stats-json', type=str, default='', metavar='filename',
+                        help="把每台主机各阶段的原始耗时写入指定的JSON文件，便于对比不同版本的性能")
+    parser.add_argument('--slowest', type=int, default=5, metavar='number', help="性能报告中列出最慢的主机数，默认为5")
+    parser.add_argument('-o', '--output', type=str, default='', metavar='filename',
+                        help="把每台主机的结果按批写入指定文件，控制台只显示一行实时汇总")
+    parser.add_argument('--format', type=str, default='jsonl', choices=['jsonl', 'csv'], help="--output的文件格式，默认为jsonl")
+    parser.add_argument('--journal', type=str, default='', metavar='filename',
+                        help="把每台主机的配置结果(主机、分配的地址、状态)追加写入指定的日志文件，按批fsync\n" +
+                             "运行中断后可以用--resume从该文件继续")
+    parser.add_argument('--resume', type=str, default='', metavar='filename',
+                        help="读取--journal写入的日志文件，跳过已经配置成功的主机，其它主机沿用日志中分配的地址\n" +
+                             "没有指定--journal时继续追加写入该文件")
+    parser.add_argument('--ledger', type=str, default='', metavar='filename',
+                        help="SQLite地址账本，记录每个地址分配给了哪台主机、属于哪个网段，需要和-n一起使用\n" +
+                             "分配时跳过账本中已经占用的地址，不再需要手工维护-F排除文件\n" +
+                             "不加--add时主机沿用账本中已有的地址；--sub时减少账本中记录的地址，成功后从账本中释放\n" +
+                             "--resume日志中的地址被账本中的其它主机占用时，在连接任何主机之前报错退出")
     parser.add_argument('-S', '--sort', type=str, metavar='filename',
-                        help="过滤出指定文件中的IPv4/IPv6，并排序输出后退出程序")
+                        help="过滤出指定文件中的IPv4/IPv6，并排序输出后退出程序\n" +
+                             "文件通过mmap分块扫描，不会整个读入内存")
+    parser.add_argument('--sort-jobs', type=int, default=1, metavar='number',
+                        help="-S使用的进程数，大于1时把文件分块交给多个进程扫描，默认为1")
     parser.add_argument('-D', '--debug', action='store_true', default=False, help='输出详细日志')
     parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
     sub_command = parser.add_subparsers()
@@ -134,50 +285,88 @@ def check_ipaddr_v6(addr):
     return parsed
 
 
-def check_ipaddr_v4(addr):
+def check_ipaddr(addr):
     try:
         parsed = ipaddress.ip_address(addr)
-        if parsed.version != 4:
-            return None
     except Exception as e:
         return None
     return parsed
 
 
-def check_ipaddr(addr):
+def parse_exclude_entry(entry):
+    """
+    解析单个排除项，支持单个地址、CIDR网段(10.0.0.0/24)以及地址范围(10.0.0.5-10.0.0.9)
+    返回 (version, 起点整数, 终点整数)，不合法时返回None
+    """
     try:
-        parsed = ipaddress.ip_address(addr)
-    except Exception as e:
+        if '/' in entry:
+            net = ipaddress.ip_network(entry, strict=False)
+            return net.version, int(net.network_address), int(net.broadcast_address)
+        if '-' in entry:
+            lo, hi = entry.split('-', 1)
+            lo_parsed = ipaddress.ip_address(lo.strip())
+            hi_parsed = ipaddress.ip_address(hi.strip())
+            if lo_parsed.version != hi_parsed.version or lo_parsed > hi_parsed:
+                return None
+            return lo_parsed.version, int(lo_parsed), int(hi_parsed)
+        parsed = ipaddress.ip_address(entry)
+    except ValueError:
         return None
-    return parsed
+    return parsed.version, int(parsed), int(parsed)
+
+
+def compile_exclude(ranges):
+    """
+    把排除区间列表 [(起点, 终点), ...] 合并为有序、互不重叠且互不相邻的区间集合
+    返回 (starts, ends) 两个等长列表，供next_free二分查找使用
+    """
+    starts = []
+    ends = []
+    for lo, hi in sorted(ranges):
+        if ends and lo <= ends[-1] + 1:
+            if hi > ends[-1]:
+                ends[-1] = hi
+            continue
+        starts.append(lo)
+        ends.append(hi)
+    return starts, ends
 
 
+def next_free(exclude_index, value, step=1):
+    """
+    从value开始，沿step方向(1升序/-1降序)跳过排除区间，返回第一个未被排除的整数地址
+    区间集合已经合并过，所以最多只需要跳一次，复杂度O(log n)
+    """
+    starts, ends = exclude_index
+    i = bisect.bisect_right(starts, value) - 1
+    if i >= 0 and value <= ends[i]:
+        return ends[i] + 1 if step > 0 else starts[i] - 1
+    return value
+
+
+# 以下是逐个生成地址对象的旧实现，任务生成已经改用AddrAllocator/HashAllocator
+# generate_user和generate_addr_v2保留作为bench/bench_alloc.py的对照基准，generate_addr_v1是更早的版本
 def generate_user(params_parsed):
     if not params_parsed['network']:
         while True:
             yield None
     base_num = params_parsed['base_num']
     base_addr = params_parsed['manual_addr_parsed']
+    addr_cls = type(base_addr)
+    lower = int(params_parsed['network'].network_address)
+    upper = int(params_parsed['network'].broadcast_address)
+    exclude_index = params_parsed['exclude']
 
     def gen():
-        index = 0
+        value = int(base_addr)
         while True:
-            try:
-                ipvx_addr = base_addr + index
-                index += base_num
-                if ipvx_addr >= params_parsed['network'].broadcast_address:
-                    break  # 已经超出广播地址
-                if ipvx_addr <= params_parsed['network'].network_address:
-                    break  # 已经比网络地址更小
-                if ipvx_addr == params_parsed['gateway']:
-                    continue
-                for excludeIP in params_parsed['exclude']:
-                    if excludeIP == ipvx_addr:
-                        break
-                else:
-                    yield ipvx_addr
-            except:
-                break
+            value = next_free(exclude_index, value, base_num)
+            if value >= upper:
+                break  # 已经超出广播地址
+            if value <= lower:
+                break  # 已经比网络地址更小
+            yield addr_cls(value)
+            value += base_num
 
     yield from gen()
     while True:
@@ -189,62 +378,42 @@ def generate_addr_v2(params_parsed):
         while True:
             yield None
 
-    def gen_asc():
-        if params_parsed['starting_addr'] is not None:
-            base_addr = params_parsed['starting_addr']
-        elif params_parsed['gateway'] is not None:
-            base_addr = params_parsed['gateway'] + 1
-        else:
-            base_addr = params_parsed['network'].network_address + 1
-        index = 0
+    network = params_parsed['network']
+    addr_cls = type(network.network_address)
+    lower = int(network.network_address)
+    upper = int(network.broadcast_address)
+    exclude_index = params_parsed['exclude']
+
+    def gen_asc(value):
         while True:
-            try:
-                ipvx_addr = base_addr + index
-                index += 1
-                if ipvx_addr >= params_parsed['network'].broadcast_address:
-                    break  # 已经超出广播地址
-                if ipvx_addr == params_parsed['gateway']:
-                    continue
-                for excludeIP in params_parsed['exclude']:
-                    if excludeIP == ipvx_addr:
-                        break
-                else:
-                    yield ipvx_addr
-            except:
-                break
+            value = next_free(exclude_index, value, 1)
+            if value >= upper:
+                break  # 已经超出广播地址
+            yield addr_cls(value)
+            value += 1
 
-    def gen_desc():
-        if params_parsed['starting_addr'] is not None:
-            base_addr = params_parsed['starting_addr']
-        elif params_parsed['gateway'] is not None:
-            base_addr = params_parsed['gateway'] + 1
-        else:
-            base_addr = params_parsed['network'].broadcast_address - 1
-        index = 0
+    def gen_desc(value):
         while True:
-            try:
-                ipvx_addr = base_addr - index
-                index += 1
-                if ipvx_addr <= params_parsed['network'].network_address:
-                    break  # 已经比网络地址更小
-                if ipvx_addr == params_parsed['gateway']:
-                    continue
-                for excludeIP in params_parsed['exclude']:
-                    print(str(excludeIP), str(ipvx_addr))
-                    if excludeIP == ipvx_addr:
-                        break
-                else:
-                    yield ipvx_addr
-            except:
-                break
+            value = next_free(exclude_index, value, -1)
+            if value <= lower:
+                break  # 已经比网络地址更小
+            yield addr_cls(value)
+            value -= 1
+
+    if params_parsed['starting_addr'] is not None:
+        base_addr = int(params_parsed['starting_addr'])
+    elif params_parsed['gateway'] is not None:
+        base_addr = int(params_parsed['gateway']) + 1
+    else:
+        base_addr = lower + 1
 
-    if params_parsed['network'].network_address + 1 == params_parsed['gateway']:
-        yield from gen_asc()
-    elif params_parsed['network'].broadcast_address - 1 == params_parsed['gateway']:
-        yield from gen_desc()
+    if network.network_address + 1 == params_parsed['gateway']:
+        yield from gen_asc(base_addr)
+    elif network.broadcast_address - 1 == params_parsed['gateway']:
+        yield from gen_desc(base_addr)
     else:
-        yield from gen_asc()
-        yield from gen_desc()
+        yield from gen_asc(base_addr)
+        yield from gen_desc(base_addr - 1)  # 升序分配完后，从起点往下继续分配
 
     while True:
         yield None
@@ -255,45 +424,232 @@ def generate_addr_v1(params_parsed):
         while True:
             yield None
 
+    network = params_parsed['network']
+    addr_cls = type(network.network_address)
     if params_parsed['starting_addr'] is not None:
-        base_addr = params_parsed['starting_addr']
+        value = int(params_parsed['starting_addr'])
     else:
-        base_addr = params_parsed['network'].network_address + 1
-    index = 0
+        value = int(network.network_address) + 1
+    upper = int(network.broadcast_address)
     while True:
-        ipvx_addr = base_addr + index
-        index += 1
-        if ipvx_addr == params_parsed['gateway'] or ipvx_addr == params_parsed['network'].broadcast_address:
-            continue
-        elif ipvx_addr > params_parsed['network'].broadcast_address:
+        value = next_free(params_parsed['exclude'], value, 1)
+        if value >= upper:
             break
-        for excludeIP in params_parsed['exclude']:
-            if excludeIP == ipvx_addr:
-                continue
-        yield ipvx_addr
+        yield addr_cls(value)
+        value += 1
     while True:
         yield None
 
 
+def free_blocks(exclude_index, value, stop, step=1):
+    """
+    从value开始沿step方向产出连续的未排除地址段(range对象)，不包含stop本身
+    每跳过一个排除区间只需要一次二分查找，段内地址不再逐个比较
+    """
+    starts, ends = exclude_index
+    if step > 0:
+        while value < stop:
+            value = next_free(exclude_index, value, 1)
+            if value >= stop:
+                break
+            i = bisect.bisect_right(starts, value)
+            end = min(starts[i], stop) if i < len(starts) else stop
+            yield range(value, end)
+            value = end
+    else:
+        while value > stop:
+            value = next_free(exclude_index, value, -1)
+            if value <= stop:
+                break
+            i = bisect.bisect_right(starts, value) - 1
+            low = max(ends[i], stop) if i >= 0 else stop
+            yield range(value, low, -1)
+            value = low
+
+
+class AddrAllocator(object):
+    """
+    基于整数的批量地址分配器，分配顺序与generate_addr_v2/generate_user一致
+    allocate一次返回最多count个整数地址，只有需要时才通过to_address转换为IPv4Address/IPv6Address
+    """
+
+    def __init__(self, params_parsed):
+        self.blocks = iter(())
+        self.current = range(0)
+        network = params_parsed['network']
+        if not network:
+            return
+        self.addr_cls = type(network.network_address)
+        lower = int(network.network_address)
+        upper = int(network.broadcast_address)
+        exclude_index = params_parsed['exclude']
+        if params_parsed['manual_addr_parsed']:
+            base_addr = int(params_parsed['manual_addr_parsed'])
+            if params_parsed['base_num'] > 0:
+                self.blocks = free_blocks(exclude_index, base_addr, upper, 1)
+            else:
+                self.blocks = free_blocks(exclude_index, base_addr, lower, -1)
+            return
+        if params_parsed['starting_addr'] is not None:
+            base_addr = int(params_parsed['starting_addr'])
+        elif params_parsed['gateway'] is not None:
+            base_addr = int(params_parsed['gateway']) + 1
+        else:
+            base_addr = lower + 1
+        if network.network_address + 1 == params_parsed['gateway']:
+            self.blocks = free_blocks(exclude_index, base_addr, upper, 1)
+        elif network.broadcast_address - 1 == params_parsed['gateway']:
+            self.blocks = free_blocks(exclude_index, base_addr, lower, -1)
+        else:
+            self.blocks = itertools.chain(free_blocks(exclude_index, base_addr, upper, 1),
+                                          free_blocks(exclude_index, base_addr - 1, lower, -1))
+
+    def allocate(self, count):
+        """分配最多count个地址，返回整数列表，地址不够时返回的数量会少于count"""
+        result = []
+        while len(result) < count:
+            if not self.current:
+                self.current = next(self.blocks, None)
+                if self.current is None:
+                    self.current = range(0)
+                    break
+            need = count - len(result)
+            result.extend(self.current[:need])
+            self.current = self.current[need:]
+        return result
+
+    def to_address(self, value):
+        return self.addr_cls(value)
+
+
+class HashAllocator(object):
+    """
+    --v6-assign hash：由主机管理地址的稳定哈希(blake2b)得到接口标识，不需要按顺序扫描网段
+    候选地址落在排除区间(包括网关、网络地址和广播地址)中或已经分配给其它主机时，依次用序号1、2...重新哈希，
+    连续HASH_PROBES次冲突后从最后的候选地址开始升序取第一个空闲地址，到网段末尾后从头开始
+    主机之间的冲突按地址池的顺序解决，所以每个分片都对完整的地址池计算
+    """
+    HASH_PROBES = 16
+
+    def __init__(self, params_parsed):
+        import hashlib
+        self.blake2b = hashlib.blake2b
+        network = params_parsed['network']
+        self.lower = int(network.network_address)
+        self.upper = int(network.broadcast_address)
+        self.exclude_index = params_parsed['exclude']
+        self.used = set()
+        starts, ends = self.exclude_index
+        self.free = self.upper - self.lower + 1 - sum(
+            max(0, min(hi, self.upper) - max(lo, self.lower) + 1) for lo, hi in zip(starts, ends))
+
+    def is_free(self, value):
+        return value not in self.used and next_free(self.exclude_index, value) == value
+
+    def candidate(self, host, probe):
+        digest = self.blake2b('{}#{}'.format(host, probe).encode(), digest_size=16, person=b'cfgnet-v6').digest()
+        return self.lower + int.from_bytes(digest, 'big') % (self.upper - self.lower + 1)
+
+    def scan(self, value):
+        while True:
+            value = next_free(self.exclude_index, value, 1)
+            if value > self.upper:
+                value = self.lower
+            elif value in self.used:
+                value += 1
+            else:
+                return value
+
+    def assign(self, host, count):
+        """为host分配count个地址，返回整数元组，网段中没有足够的空闲地址时返回None"""
+        if self.free < count:
+            return None
+        values = []
+        probe = 0
+        for _ in range(count):
+            for _ in range(self.HASH_PROBES):
+                value = self.candidate(host, probe)
+                probe += 1
+                if self.is_free(value):
+                    break
+            else:
+                value = self.scan(value)
+            self.used.add(value)
+            values.append(value)
+        self.free -= count
+        return tuple(values)
+
+
 def parsed_params(args):
     global DEBUG
     DEBUG = args.debug
 
     if DEBUG:
+        from pprint import pprint
         pprint(args)
 
-    if args.concurrency == 0:
-        logging.error("消费工作协程数必须大于等于1")
-        return
+    auto_concurrency = args.concurrency.strip().lower() == 'auto'
+    if auto_concurrency:
+        concurrency = args.max_concurrency
+        if args.min_concurrency < 1 or args.max_concurrency < args.min_concurrency:
+            logging.error("--min-concurrency必须大于等于1，并且不能大于--max-concurrency")
+            return
+    else:
+        try:
+            concurrency = int(args.concurrency)
+        except ValueError:
+            logging.error("并发数必须是整数或者auto：%s" % args.concurrency)
+            return
+        if concurrency < 1:
+            logging.error("消费工作协程数必须大于等于1")
+            return
 
     if args.add is True and args.sub is True:
         logging.error("--add和--sub不能同时存在，只能选择其中一个")
         return
 
+    if args.noup and args.apply_strategy not in ('', 'none'):
+        logging.error("--noup和--apply-strategy %s不能同时存在" % args.apply_strategy)
+        return
+
     if args.cname != '' and args.eth != '':
         logging.error("--eth和--cname不能同时存在，只能选择其中一个")
         return
 
+    if args.facts_ttl < 0:
+        logging.error("--facts-ttl不能小于0")
+        return
+
+    if min(args.connect_timeout, args.cmd_timeout, args.up_timeout, args.deadline) < 0:
+        logging.error("--connect-timeout、--cmd-timeout、--up-timeout和--deadline不能小于0")
+        return
+
+    if args.retries < 0 or args.retry_backoff < 0:
+        logging.error("--retries和--retry-backoff不能小于0")
+        return
+
+    if args.connect_rate < 0 or args.connect_subnet_max < 0:
+        logging.error("--connect-rate和--connect-subnet-max不能小于0")
+        return
+    if not 0 <= args.connect_subnet_prefix <= 32:
+        logging.error("--connect-subnet-prefix必须在0到32之间")
+        return
+
+    if args.per_host < 1:
+        logging.error("--per-host必须大于等于1")
+        return
+
+    if args.workers < 1:
+        logging.error("--workers必须大于等于1")
+        return
+    shard = (0, 1)
+    if args.shard.strip() != '':
+        shard_match = re.match(r'^(\d+)/(\d+)$', args.shard.strip())
+        if not shard_match or not 1 <= int(shard_match.group(1)) <= int(shard_match.group(2)):
+            logging.error("--shard的格式为i/N，其中1 <= i <= N：%s" % args.shard)
+            return
+        shard = (int(shard_match.group(1)) - 1, int(shard_match.group(2)))
+
     params_parsed = {
         'device': args.eth,
         'cname': args.cname,
@@ -308,7 +664,41 @@ def parsed_params(args):
         'user': args.user.strip(),
         'test_cmd': args.test,
         'manual_addr': '',
-        'no_up': args.noup,
+        'apply_strategy': args.apply_strategy or ('none' if args.noup else 'reload-up'),
+        'one_shot': args.oneshot,
+        'diff': args.diff,
+        'precheck': args.precheck,
+        'verify': args.verify,
+        'conn_max': args.conn_max,
+        'conn_idle': args.conn_idle,
+        'connect_timeout': args.connect_timeout,
+        'cmd_timeout': args.cmd_timeout,
+        'up_timeout': args.up_timeout,
+        'deadline': args.deadline,
+        'retries': args.retries,
+        'retry_backoff': args.retry_backoff,
+        'connect_rate': args.connect_rate,
+        'connect_subnet_max': args.connect_subnet_max,
+        'connect_subnet_prefix': args.connect_subnet_prefix,
+        'facts_cache': args.facts_cache,
+        'facts_ttl': args.facts_ttl,
+        'no_agent': args.no_agent,
+        'concurrency': concurrency,
+        'auto_concurrency': auto_concurrency,
+        'min_concurrency': args.min_concurrency,
+        'max_concurrency': args.max_concurrency,
+        'stats_json': args.stats_json,
+        'slowest': args.slowest,
+        'output': args.output,
+        'format': args.format,
+        'journal': args.journal or args.resume,
+        'resume': {},
+        'workers': args.workers,
+        'shard': shard,
+        'per_host': args.per_host,
+        'v6_assign': args.v6_assign,
+        'ledger': args.ledger,
+        'ledger_hosts': None,
     }
 
     if args.pool is None:
@@ -335,60 +725,29 @@ def parsed_params(args):
             exclude_pool = exclude_param
         if exclude_pool is None:
             return
-        for exc_ip in exclude_pool.split():
+        exclude_pool = re.sub(r'#[^\n]*', '', exclude_pool)  # 先去掉#到行尾的注释再拆分
+        for exc_ip in re.split(r'[\s,]+', exclude_pool):
             exc_ip = exc_ip.strip()
             if exc_ip == "":
                 continue
-            parsed_inner = check_ipaddr(exc_ip)
+            parsed_inner = parse_exclude_entry(exc_ip)
             if parsed_inner is None:
-                logging.error("指定的排除地址不是合法的IP地址：%s" % exc_ip)
+                logging.error("指定的排除地址不是合法的IP地址、网段或地址范围：%s" % exc_ip)
                 return False
-            if parsed_inner.version != params_parsed['net_type']:
-                logging.error("指定的排除地址类型必须一致：%s" % str(parsed_inner))
+            version, lo, hi = parsed_inner
+            if version != params_parsed['net_type']:
+                logging.error("指定的排除地址类型必须一致：%s" % exc_ip)
                 return False
-            exclude.append(parsed_inner)
+            exclude.append((lo, hi))
 
-    pool_content = read(args.pool)
-    if pool_content is None:
+    pool = HostPool.load(args.pool, params_parsed['user'] or 'root')
+    if pool is None:
         return
-    pool_hosts = {}
-    for row in pool_content.split("\n"):  # v4地址
-        row = row.strip()
-        if row == "" or row.startswith("#"):
-            continue
-        if len(row.split()) != 1:
-            continue
-        c_host, c_port, c_user = parse_host(row)
-        ip_parsed = check_ipaddr_v4(c_host)
-        if ip_parsed is None:
-            logging.error("指定池{}中的IP不合法: {}".format(args.pool, c_host))
-            return
-        if c_host not in pool_hosts:
-            if c_user == '':
-                if params_parsed['user'] != '':
-                    c_user = params_parsed['user']
-                else:
-                    c_user = 'root'
-            pool_hosts[c_host] = {
-                'host': c_host,
-                'port': c_port,
-                'user': c_user,
-                "host_parsed": ip_parsed,
-            }
-    if len(pool_hosts) == 0:
+    if len(pool) == 0:
         logging.warning("池中没有IP地址")
         return
-    pool_parsed = {}
-    for _, val in pool_hosts.items():
-        pool_parsed[val['host_parsed']] = val
-    pool_parsed_sorted = []
-    if params_parsed['nsort']:
-        tmp_pool_data = pool_parsed
-    else:
-        tmp_pool_data = sorted(pool_parsed, reverse=params_parsed['order'])
-    for item in tmp_pool_data:
-        pool_parsed_sorted.append(pool_parsed[item])
-    params_parsed['pool'] = pool_parsed_sorted
+    pool.build(nsort=params_parsed['nsort'], reverse=params_parsed['order'])
+    params_parsed['pool'] = pool
 
     network = args.network
     if network is not None and network != '':
@@ -508,15 +867,102 @@ def parsed_params(args):
         return
     if do_exclude(args.fexclude, True) is False:
         return
-    params_parsed['exclude'] = exclude
-
-    if args.askpass:
-        password = getpass.getpass('Password:')
-        params_parsed['password'] = password
-    else:
+    if args.per_host > 1 and params_parsed['network'] is None:
+        logging.error("--per-host需要和-n一起使用")
+        return
+    if args.v6_assign == 'hash':
+        if params_parsed['network'] is None or params_parsed['network'].version != 6:
+            logging.error("--v6-assign hash需要用-n指定IPv6网段")
+            return
+        if params_parsed['starting_addr'] is not None or params_parsed['manual_addr_parsed'] is not None:
+            logging.error("--v6-assign hash不能和-s、-m、--manual-desc同时使用")
+            return
+    if args.resume:
+        journal = load_journal(args.resume)
+        if journal is None:
+            return
+        for host, (ip_text, status) in journal.items():
+            ip_values = None
+            if ip_text is not None and params_parsed['network'] is not None:
+                ip_values = []
+                for ip_item in ip_text.split(','):
+                    ip_parsed = check_ipaddr(ip_item)
+                    if ip_parsed is None or ip_parsed not in params_parsed['network']:
+                        logging.error("日志{}中主机{}的地址{}不在指定的网段中".format(args.resume, host, ip_item))
+                        return
+                    ip_values.append(int(ip_parsed))
+                    # 日志中已经分配的地址不再分配给其它主机
+                    exclude.append((ip_values[-1], ip_values[-1]))
+                if len(ip_values) != args.per_host:
+                    logging.error("日志{}中主机{}有{}个地址，与--per-host {}不一致".format(
+                        args.resume, host, len(ip_values), args.per_host))
+                    return
+                ip_values = tuple(ip_values)
+            params_parsed['resume'][host] = (ip_values, status)
+        skipped = sum(1 for host, _, _ in params_parsed['pool']
+                      if params_parsed['resume'].get(str(host), (None, False))[1])
+        logging.warning("根据日志跳过{}台已经配置成功的主机".format(skipped))
+    if args.ledger:
+        if params_parsed['network'] is None:
+            logging.error("--ledger需要和-n一起使用")
+            return
+        ledger = Ledger.open(args.ledger, params_parsed['network'])
+        if ledger is None:
+            return
+        owners = ledger.owners()
+        ledger.close()
+        ledger_hosts = {}
+        for value, host in owners:
+            # 账本中已经分配的地址不再分配给其它主机
+            exclude.append((value, value))
+            ledger_hosts.setdefault(host, []).append(value)
+        if params_parsed['resume']:
+            owner_of = dict(owners)
+            for host, (ip_values, status) in params_parsed['resume'].items():
+                for ip_value in ip_values or ():
+                    if owner_of.get(ip_value, host) != host:
+                        logging.error("日志{}中主机{}的地址{}在账本{}中属于主机{}".format(
+                            args.resume, host, type(params_parsed['network'].network_address)(ip_value),
+                            args.ledger, owner_of[ip_value]))
+                        return
+        params_parsed['ledger_hosts'] = {host: tuple(values) for host, values in ledger_hosts.items()}
+        if args.sub:
+            missing = sum(1 for host, _, _ in params_parsed['pool'] if str(host) not in params_parsed['ledger_hosts'])
+            if missing:
+                logging.warning("账本中没有{}的地址的{}台主机不执行--sub".format(params_parsed['network'], missing))
+    # 网关、网络地址和广播地址与排除列表一起编译为一个有序区间集合
+    if params_parsed['gateway'] is not None:
+        exclude.append((int(params_parsed['gateway']), int(params_parsed['gateway'])))
+    if params_parsed['network'] is not None:
+        exclude.append((int(params_parsed['network'].network_address), int(params_parsed['network'].network_address)))
+        exclude.append((int(params_parsed['network'].broadcast_address),
+                        int(params_parsed['network'].broadcast_address)))
+    params_parsed['exclude'] = compile_exclude(exclude)
+
+    if args.ipaddr:
+        # -I只显示地址分配结果，不读取密码、私钥和known_hosts
         params_parsed['password'] = None
+        params_parsed['client_keys'] = []
+        params_parsed['known_hosts'] = None
+    else:
+        if not import_ssh():
+            return
+        if args.askpass:
+            import getpass
+            password = getpass.getpass('Password:')
+            params_parsed['password'] = password
+            params_parsed['client_keys'] = []
+        else:
+            params_parsed['password'] = None
+            params_parsed['client_keys'] = load_client_keys(args.identity)
+            if params_parsed['client_keys'] is None:
+                return
+        params_parsed['known_hosts'] = load_known_hosts(args.known_hosts)
+        if params_parsed['known_hosts'] is False:
+            return
 
     if DEBUG:
+        from pprint import pprint
         pprint(params_parsed)
     return params_parsed
 
@@ -534,310 +980,2085 @@ def parse_host(host, default_user='', default_port=22):
     return host, port, user
 
 
+class HostPool(object):
+    """
+    -p指定的地址池：逐行流式读取，每行[user@]entry[:port]中的entry可以是单个地址、CIDR网段(10.0.0.0/22)
+    或地址范围(10.0.1.5-10.0.1.200)，只支持v4，网段中不包括网络地址和广播地址(/31、/32除外)
+    每行只保存为一个整数区间和(端口号, 用户名)的编号，迭代时才展开成主机，大网段和几十万行的文件都不需要逐台保存
+    build用扫描线把各行的区间切分为互不重叠的段(起点, 终点, 行号)，同一地址出现在多行时属于最先出现的行，
+    排序和去重都只比较整数
+    """
+
+    def __init__(self):
+        self.lows = array.array('I')
+        self.highs = array.array('I')
+        self.target_ids = array.array('I')
+        self.targets = {}  # (端口号, 用户名) -> 编号
+        self.seg_lows = array.array('I')
+        self.seg_highs = array.array('I')
+        self.seg_rows = array.array('I')
+        self.order = None
+        self.reverse = False
+        self.size = 0
+
+    @classmethod
+    def load(cls, filename, default_user):
+        """读取地址池文件，文件打不开或有不合法的行时记录错误并返回None"""
+        pool = cls()
+        add_low, add_high, add_target = pool.lows.append, pool.highs.append, pool.target_ids.append
+        default_target = pool.targets.setdefault((22, default_user), 0)
+        inet_pton, from_bytes, af_inet = socket.inet_pton, int.from_bytes, socket.AF_INET
+        try:
+            with open(filename, encoding="utf8", mode='r') as fd:
+                for lineno, row in enumerate(fd, 1):
+                    row = row.strip()
+                    if row == "" or row[0] == "#":
+                        continue
+                    try:
+                        # 大多数行只有一个地址，不需要再拆分用户名和端口号
+                        value = from_bytes(inet_pton(af_inet, row), 'big')
+                    except OSError:
+                        pass
+                    else:
+                        add_low(value)
+                        add_high(value)
+                        add_target(default_target)
+                        continue
+                    if len(row.split()) != 1:
+                        continue
+                    entry, port, user = parse_host(row, default_user)
+                    bounds = cls.parse_entry(entry)
+                    if bounds is None:
+                        logging.error("指定池{}第{}行的IP不合法: {}".format(filename, lineno, entry))
+                        return None
+                    try:
+                        port = int(port)
+                    except ValueError:
+                        port = 0
+                    if not 0 < port < 65536:
+                        logging.error("指定池{}第{}行的端口号不合法: {}".format(filename, lineno, row))
+                        return None
+                    add_low(bounds[0])
+                    add_high(bounds[1])
+                    add_target(pool.targets.setdefault((port, user or default_user), len(pool.targets)))
+        except OSError as e:
+            logging.error("文件打开出错：%s" % e)
+            return None
+        return pool
+
+    @staticmethod
+    def parse_entry(entry):
+        """返回(起点整数, 终点整数)，不合法时返回None"""
+        if '/' in entry:
+            try:
+                net = ipaddress.IPv4Network(entry, strict=False)
+            except ValueError:
+                return None
+            if net.prefixlen >= 31:
+                return int(net.network_address), int(net.broadcast_address)
+            return int(net.network_address) + 1, int(net.broadcast_address) - 1
+        if '-' in entry:
+            parsed = parse_exclude_entry(entry)
+            if parsed is None or parsed[0] != 4:
+                return None
+            return parsed[1], parsed[2]
+        try:
+            value = int.from_bytes(socket.inet_pton(socket.AF_INET, entry), 'big')
+        except OSError:
+            return None
+        return value, value
+
+    def build(self, nsort=False, reverse=False):
+        """切分并排序：默认按地址升序，reverse为降序，nsort保持文件中的顺序"""
+        lows, highs = self.lows, self.highs
+        seg_lows, seg_highs, seg_rows = self.seg_lows, self.seg_highs, self.seg_rows
+        starts = sorted(range(len(lows)), key=lows.__getitem__)
+        count = len(starts)
+        active = []  # 覆盖当前地址的行组成的堆 (行号, 终点)，行号最小的行拥有当前地址
+        i = 0
+        value = 0
+        while i < count or active:
+            if not active:
+                row = starts[i]
+                value = lows[row]
+                end = highs[row]
+                i += 1
+                if i == count or lows[starts[i]] > end:
+                    # 与其它行不重叠时不需要经过堆
+                    seg_lows.append(value)
+                    seg_highs.append(end)
+                    seg_rows.append(row)
+                    self.size += end - value + 1
+                    continue
+                heapq.heappush(active, (row, end))
+            while i < count and lows[starts[i]] <= value:
+                heapq.heappush(active, (starts[i], highs[starts[i]]))
+                i += 1
+            while active and active[0][1] < value:
+                heapq.heappop(active)
+            if not active:
+                continue
+            row, end = active[0]
+            if i < count and lows[starts[i]] <= end:
+                end = lows[starts[i]] - 1  # 之后开始的行可能先出现在文件中
+            if seg_rows and seg_rows[-1] == row and seg_highs[-1] + 1 == value:
+                seg_highs[-1] = end
+            else:
+                seg_lows.append(value)
+                seg_highs.append(end)
+                seg_rows.append(row)
+            self.size += end - value + 1
+            value = end + 1
+        self.lows = self.highs = None
+        if nsort:
+            self.order = array.array('I', sorted(range(len(seg_rows)),
+                                                 key=lambda s: seg_rows[s] << 32 | seg_lows[s]))
+        else:
+            self.reverse = reverse
+
+    def __len__(self):
+        return self.size if self.lows is None else len(self.lows)
+
+    def __iter__(self):
+        """依次返回(IPv4Address, 端口号, 用户名)"""
+        targets = list(self.targets)
+        address = ipaddress.IPv4Address
+        if self.order is not None:
+            segments = self.order
+        elif self.reverse:
+            segments = range(len(self.seg_rows) - 1, -1, -1)
+        else:
+            segments = range(len(self.seg_rows))
+        for s in segments:
+            port, user = targets[self.target_ids[self.seg_rows[s]]]
+            if self.reverse:
+                values = range(self.seg_highs[s], self.seg_lows[s] - 1, -1)
+            else:
+                values = range(self.seg_lows[s], self.seg_highs[s] + 1)
+            for value in values:
+                yield address(value), port, user
+
+
+class RunPlan(object):
+    """
+    整批任务共用的只读配置，所有HostTask引用同一个RunPlan，不再为每台主机复制一份
+    创建后不能再修改属性；addr_cls为分配地址的类型，IPv4Address或IPv6Address
+    """
+    __slots__ = ('ip_netmask', 'ip_gateway', 'ip_dns', 'device', 'connection', 'net_type', 'is_add', 'is_sub',
+                 'cfg_ipaddr', 'apply_strategy', 'one_shot', 'connect_timeout', 'cmd_timeout', 'up_timeout', 'diff',
+                 'addr_cls')
+
+    def __init__(self, ip_netmask, ip_gateway, ip_dns, device, connection, net_type, is_add, is_sub, cfg_ipaddr,
+                 apply_strategy, one_shot, connect_timeout=15.0, cmd_timeout=30.0, up_timeout=90.0, diff=False,
+                 addr_cls=None):
+        values = locals()
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RunPlan is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("RunPlan is read-only")
+
+    def __reduce__(self):
+        # --workers通过管道发送HostTask时按构造参数重建，不经过__setattr__
+        return RunPlan, tuple(getattr(self, name) for name in self.__slots__)
+
+    @classmethod
+    def from_params(cls, params_parsed):
+        network = params_parsed['network']
+        if network:
+            prefix_len = network.prefixlen
+        elif params_parsed['net_type'] == 6:
+            prefix_len = 128
+        else:
+            prefix_len = 32
+        return cls(
+            ip_netmask=prefix_len,
+            ip_gateway=params_parsed['gateway'],
+            ip_dns=params_parsed['dns'],
+            device=params_parsed['device'],  # 将要在此接口上配置IP地址
+            connection=params_parsed['cname'],
+            net_type=params_parsed['net_type'],
+            is_add=params_parsed['add'],
+            is_sub=params_parsed['sub'],
+            cfg_ipaddr=bool(network),
+            apply_strategy=params_parsed['apply_strategy'],
+            one_shot=params_parsed['one_shot'],
+            connect_timeout=params_parsed['connect_timeout'],
+            cmd_timeout=params_parsed['cmd_timeout'],
+            up_timeout=params_parsed['up_timeout'],
+            diff=params_parsed['diff'],
+            addr_cls=type(network.network_address) if network else None,
+        )
+
+
+class HostTask(object):
+    """
+    一台主机的任务状态，只保存每台主机不同的字段，分配到的地址以整数保存在ip_value中
+    --per-host大于1时，第一个之后的地址以整数元组保存在ip_extra中
+    """
+    __slots__ = ('plan', 'address', 'port', 'user', 'ip_value', 'ip_extra', 'device', 'uuid', 'phase', 'cmd', 'cmd_result',
+                 'cmd_stderr', 'cmd_status', 'error_kind', 'connect_time', 'timings', 'enqueued', 'attempts',
+                 'step', 'unchanged')
+
+    def __init__(self, plan, address, port, user, ip_value=None, ip_extra=()):
+        self.plan = plan
+        self.address = address
+        self.port = port
+        self.user = user
+        self.ip_value = ip_value
+        self.ip_extra = ip_extra
+        self.device = plan.device
+        self.uuid = ""
+        self.phase = "apply"
+        self.cmd = []
+        self.cmd_result = ""
+        self.cmd_stderr = ""
+        self.cmd_status = False
+        self.error_kind = None
+        self.connect_time = None
+        self.timings = {}
+        self.enqueued = 0.0
+        self.attempts = 0
+        self.step = None  # 正在执行的步骤，--deadline取消时报告
+        self.unchanged = False  # --diff时主机已经是要求的配置，没有执行修改
+
+    @property
+    def ip_address(self):
+        if self.ip_value is None:
+            return None
+        return self.plan.addr_cls(self.ip_value)
+
+    @property
+    def ip_addresses(self):
+        if self.ip_value is None:
+            return []
+        return [self.plan.addr_cls(value) for value in (self.ip_value,) + self.ip_extra]
+
+    @property
+    def ip_text(self):
+        """以英文逗号连接的所有地址，用于显示和写入结果文件，没有分配地址时为None"""
+        if self.ip_value is None:
+            return None
+        return ','.join(str(addr) for addr in self.ip_addresses)
+
+    def as_dict(self):
+        result = {name: getattr(self, name) for name in self.__slots__}
+        result['ip_address'] = self.ip_text
+        return result
+
+
 def generate_tasks(params_parsed):
     """
     脚本功能：
     1. 为每台机器配置v4/v6版本的IP地址，网关，DNS，以及以上三者之间的任意组合
     2. 当参数中提供了网段时，就认为有机器配置IP地址，
     """
-    cfg_ipaddr = False
-    if params_parsed['network']:
-        cfg_ipaddr = True
-        prefix_len = params_parsed['network'].prefixlen
-    else:
-        if params_parsed['net_type'] == 6:
-            prefix_len = 128
-        elif params_parsed['net_type'] == 4:
-            prefix_len = 32
-        else:
-            prefix_len = 32
-    if params_parsed['manual_addr_parsed']:
-        gen_addr = generate_user(params_parsed)
-    else:
-        gen_addr = generate_addr_v2(params_parsed)
-    for host_info in params_parsed['pool']:
-        ipvx_addr = next(gen_addr)
-        if cfg_ipaddr and ipvx_addr is None:
-            logging.error("提供的网段不够为所有主机分配IP地址")
-            break
-        task = {
-            "address": host_info['host_parsed'],
-            "ip_address": ipvx_addr,
-            "ip_netmask": prefix_len,
-            "ip_gateway": params_parsed['gateway'],
-            "ip_dns": params_parsed['dns'],
-            "device": params_parsed['device'],  # 将要在此接口上配置IP地址
-            "connection": params_parsed['cname'],
-            "net_type": params_parsed['net_type'],
-            "is_add": params_parsed['add'],
-            "is_sub": params_parsed['sub'],
-            "uuid": "",
-            "cmd_result": "",
-            "cmd_stderr": "",
-            "cmd_status": False,
-            "cmd": [],
-            "ssh_info": host_info,
-            "ssh_password": params_parsed['password'],
-            "cfg_ipaddr": cfg_ipaddr,
-            "test_cmd": params_parsed['test_cmd'],
-            # "params_parsed": params_parsed
-            "no_up": params_parsed['no_up'],
-        }
-        yield task
+    plan = RunPlan.from_params(params_parsed)
+    allocator = AddrAllocator(params_parsed)
+    resume = params_parsed['resume']
+    shard_index, shard_count = params_parsed['shard']
+    per_host = params_parsed['per_host']
+    hasher = HashAllocator(params_parsed) if params_parsed['v6_assign'] == 'hash' else None
+    ledger_hosts = params_parsed['ledger_hosts']
+    batch = []
+    for index, (host, port, user) in enumerate(params_parsed['pool']):
+        ip_values = None
+        if resume:
+            ip_values, status = resume.get(str(host), (None, False))
+            if status:
+                continue
+        if ip_values is None and ledger_hosts is not None and not plan.is_add:
+            # --ledger：--sub减少账本中记录的地址，替换时沿用账本中数量相同的地址
+            ip_values = ledger_hosts.get(str(host))
+            if plan.is_sub and ip_values is None:
+                continue
+            if not plan.is_sub and ip_values is not None and len(ip_values) != per_host:
+                ip_values = None
+        if plan.cfg_ipaddr and ip_values is None and hasher is not None:
+            ip_values = hasher.assign(str(host), per_host)
+            if ip_values is None:
+                logging.error("提供的网段不够为所有主机分配IP地址")
+                break
+        elif plan.cfg_ipaddr and ip_values is None:
+            if len(batch) < per_host:
+                batch[:0] = reversed(allocator.allocate(max(ALLOC_BATCH, per_host)))
+            if len(batch) < per_host:
+                logging.error("提供的网段不够为所有主机分配IP地址")
+                break
+            ip_values = tuple(batch.pop() for _ in range(per_host))
+        # 所有分片按完整的地址池分配地址，只执行属于本分片的主机
+        if index % shard_count != shard_index:
+            continue
+        if ip_values is None:
+            ip_values = (None,)
+        yield HostTask(plan, host, port, user, ip_values[0], ip_values[1:])
     while True:
         yield None
 
 
-async def run_command(conn, cmd, task):
+class SSHConnPool(object):
+    """
+    按(host, port, user)复用SSH连接，供探测(-T/--precheck)、配置和校验(--verify)等阶段共享
+    空闲超过idle_timeout秒的连接会被关闭；max_open限制同时打开的连接数，0为不限制
+    """
+
+    def __init__(self, max_open=0, idle_timeout=300):
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.idle = {}  # key -> [conn, ...]
+        self.lru = collections.OrderedDict()  # conn -> (key, 最后使用时间)，最早空闲的在前
+        self.opened = 0
+        self.handshakes = 0
+        self.cond = asyncio.Condition()
+
+    def _drop_idle(self, conn):
+        key, _ = self.lru.pop(conn)
+        self.idle[key].remove(conn)
+        if not self.idle[key]:
+            del self.idle[key]
+        self.opened -= 1
+        conn.close()
+
+    def _reap(self):
+        expire = time.monotonic() - self.idle_timeout
+        while self.lru:
+            conn, (_, last_used) = next(iter(self.lru.items()))
+            if last_used > expire:
+                break
+            self._drop_idle(conn)
+
+    async def acquire(self, key, connect):
+        """
+        取出key对应的空闲连接，没有时调用connect()新建
+        连接数达到上限时先关闭最久未用的空闲连接，没有空闲连接则等待其它任务归还
+        """
+        async with self.cond:
+            while True:
+                self._reap()
+                for conn in reversed(self.idle.get(key, [])):
+                    self.lru.pop(conn)
+                    self.idle[key].remove(conn)
+                    if not self.idle[key]:
+                        del self.idle[key]
+                    if not conn.is_closed():
+                        return conn
+                    self.opened -= 1
+                    break
+                else:
+                    if not self.max_open or self.opened < self.max_open:
+                        self.opened += 1
+                        break
+                    if self.lru:
+                        self._drop_idle(next(iter(self.lru)))
+                        continue
+                    await self.cond.wait()
+        try:
+            conn = await connect()
+        except BaseException:
+            async with self.cond:
+                self.opened -= 1
+                self.cond.notify()
+            raise
+        self.handshakes += 1
+        return conn
+
+    async def release(self, key, conn, reuse=True):
+        async with self.cond:
+            if reuse and not conn.is_closed():
+                self.idle.setdefault(key, []).append(conn)
+                self.lru[conn] = (key, time.monotonic())
+            else:
+                self.opened -= 1
+                conn.close()
+            self._reap()
+            self.cond.notify()
+
+    async def close(self):
+        async with self.cond:
+            conns = list(self.lru)
+            for conn in conns:
+                self._drop_idle(conn)
+        for conn in conns:
+            await conn.wait_closed()
+
+
+def default_conn_max():
+    """没有指定--conn-max时按RLIMIT_NOFILE的软限制计算连接池上限，不限制时返回0"""
+    import resource
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return 0
+    return max(1, soft - CONN_RESERVED_FDS)
+
+
+def record_result(task, returncode, stdout, stderr):
+    if returncode == 0:
+        task.cmd_result = str(stdout)
+        task.cmd_status = True
+    else:
+        task.cmd_stderr = str(stderr)
+        task.cmd_status = False
+
+
+def mark(task, label, begin):
+    """记录一个阶段的开始时间(time.monotonic)和耗时"""
+    task.timings[label] = (begin, time.monotonic() - begin)
+
+
+def command_timeout(task, label):
+    """按命令类别返回超时时间：激活连接(up、reapply)和--oneshot脚本使用--up-timeout，其它命令使用--cmd-timeout，0为不限制"""
+    timeout = task.plan.up_timeout if label in ('up', 'reapply', 'script') else task.plan.cmd_timeout
+    return timeout or None
+
+
+async def run_command(conn, cmd, task, label):
+    begin = time.monotonic()
+    task.step = label
     try:
-        cmd_resp = await conn.run(cmd)
-        if cmd_resp.returncode == 0:
-            task['cmd_result'] = str(cmd_resp.stdout)
-            task['cmd_status'] = True
-        else:
-            task['cmd_stderr'] = str(cmd_resp.stderr)
-            task['cmd_status'] = False
+        cmd_resp = await conn.run(cmd, timeout=command_timeout(task, label))
+        record_result(task, cmd_resp.returncode, cmd_resp.stdout, cmd_resp.stderr)
     except asyncssh.ChannelOpenError as e:
-        task['cmd_stderr'] = str(e)
-        task['cmd_status'] = False
-    except asyncssh.TimeoutError as e:
-        task['cmd_stderr'] = str(e)
-        task['cmd_status'] = False
+        task.cmd_stderr = str(e)
+        task.cmd_status = False
+        task.error_kind = 'channel'
+    except asyncssh.TimeoutError:
+        task.cmd_stderr = "%s timeout [%ss]" % (label, command_timeout(task, label))
+        task.cmd_status = False
+        task.error_kind = 'timeout'
     except asyncssh.ProcessError as e:
-        task['cmd_stderr'] = str(e)
-        task['cmd_status'] = False
+        task.cmd_stderr = str(e)
+        task.cmd_status = False
+    except Exception as e:
+        task.cmd_stderr = str(e)
+        task.cmd_status = False
+    finally:
+        mark(task, label, begin)
+
+
+def build_modify_cmd(task, nmcli_tags):
+    """
+    生成nmcli connection modify命令，任务参数不完整时设置错误信息并返回None
+    """
+    if task.plan.net_type == 6:
+        net_type = "ipv6"
+    elif task.plan.net_type == 4:
+        net_type = "ipv4"
+    else:
+        task.cmd_stderr = "unknow net type: {}".format(task.plan.net_type)
+        task.cmd_status = False
+        return None
+    net_type_action = net_type
+    if task.plan.is_add:
+        net_type_action = "+" + net_type
+    elif task.plan.is_sub:
+        net_type_action = "-" + net_type
+    cmd_unfinished = [
+        f'nmcli connection modify "{nmcli_tags}" {net_type}.method manual',
+    ]
+    if task.ip_address:
+        # --per-host大于1时所有地址在同一条命令中配置
+        if task.plan.ip_netmask:
+            addrs = ','.join('{}/{}'.format(str(addr), task.plan.ip_netmask) for addr in task.ip_addresses)
+        else:
+            addrs = task.ip_text
+        cmd_unfinished.append('{}.addresses "{}"'.format(net_type_action, addrs))
+    if task.plan.ip_gateway:
+        cmd_unfinished.append('{}.gateway "{}"'.format(net_type_action, task.plan.ip_gateway))
+    if task.plan.ip_dns:
+        cmd_unfinished.append('{}.dns "{}"'.format(net_type_action, task.plan.ip_dns))
+    if len(cmd_unfinished) == 1:
+        task.cmd_stderr = "cmd incomplete, skip"
+        task.cmd_status = False
+        return None
+    return ' '.join(cmd_unfinished)
+
+
+def devices_cmd(nmcli_tags):
+    """查询连接所在网卡的命令，--apply-strategy reapply没有网卡名时使用"""
+    return 'nmcli -g GENERAL.DEVICES connection show "{}"'.format(nmcli_tags)
+
+
+SCRIPT_MARK = '@@cfgnet'
+SCRIPT_VARS = re.compile(r'(@DEV@|@UUID@)')
+SCRIPT_HEAD = r"""_d=$(mktemp -d) || exit 1
+trap 'rm -rf "$_d"' EXIT
+_step() {
+    eval "$1" >"$_d/o" 2>"$_d/e"
+    _rc=$?
+    printf '@@cfgnet\tstep\t%s\t%s\t%s\t%s\n' "$_rc" "$(printf '%s' "$1" | base64 -w0)" \
+        "$(base64 -w0 <"$_d/o")" "$(base64 -w0 <"$_d/e")"
+    return $_rc
+}
+_end() {
+    printf '@@cfgnet\tend\t%s\n' "$1"
+    exit 0
+}
+"""
+
+
+def shell_word(cmd):
+    """
+    把命令模板转换为一个shell单词，@DEV@/@UUID@替换为远端脚本中的$dev/$uuid变量，其余部分按字面量引用
+    """
+    parts = []
+    for part in SCRIPT_VARS.split(cmd):
+        if part == '@DEV@':
+            parts.append('"$dev"')
+        elif part == '@UUID@':
+            parts.append('"$uuid"')
+        elif part != '':
+            parts.append(shlex.quote(part))
+    return ''.join(parts)
+
+
+def build_remote_script(task):
+    """
+    把发现网卡、获取连接UUID、修改和按--apply-strategy生效合并为一个shell脚本
+    每执行一步输出一行：@@cfgnet step 返回码 base64(命令) base64(stdout) base64(stderr)
+    """
+    lines = [SCRIPT_HEAD]
+    if task.plan.connection is not None and task.plan.connection != '':
+        nmcli_tags = task.plan.connection
+    elif task.uuid:
+        nmcli_tags = task.uuid  # 使用--facts-cache中缓存的连接UUID
+        if task.device:
+            lines.append('dev={}'.format(shlex.quote(task.device)))
+    else:
+        if task.device is not None and task.device != '':
+            lines.append('dev={}'.format(shlex.quote(task.device)))
+        else:
+            lines.append('_step {} || _end fail'.format(shell_word("ip route get " + tmpl_address)))
+            lines.append('set -- $(cat "$_d/o"); dev=$5')
+            lines.append('[ -n "$dev" ] || _end route')
+        lines.append('printf \'@@cfgnet\\tvar\\tdevice\\t%s\\n\' "$dev"')
+        lines.append('_step {} || _end uuid'.format(shell_word('nmcli device connect "@DEV@"')))
+        lines.append("uuid=$(tr -s ' \\t' '\\n\\n' <\"$_d/o\" | sed '/^$/d' | tail -n 1 | tr -d \".'\")")
+        lines.append("printf '%s' \"$uuid\" | grep -Eq '^[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}' || _end uuid")
+        lines.append('printf \'@@cfgnet\\tvar\\tuuid\\t%s\\n\' "$uuid"')
+        nmcli_tags = '@UUID@'
+    cmd = build_modify_cmd(task, nmcli_tags)
+    if cmd is None:
+        return None
+    lines.append('_step {} || _end fail'.format(shell_word(cmd)))
+    if task.plan.apply_strategy == 'reapply':
+        if nmcli_tags != '@UUID@' and not task.device:
+            lines.append('_step {} || _end fail'.format(shell_word(devices_cmd(nmcli_tags))))
+            lines.append('dev=$(cut -d, -f1 <"$_d/o")')
+            lines.append('[ -n "$dev" ] || _end inactive')
+        lines.append('_step {} || _end fail'.format(shell_word('nmcli device reapply "@DEV@"')))
+    else:
+        lines.append('_step {} || _end fail'.format(shell_word('nmcli connection reload')))
+        if task.plan.apply_strategy != 'none':
+            lines.append('_step {} || _end fail'.format(shell_word('nmcli connection up "{}"'.format(nmcli_tags))))
+    lines.append('_end ok')
+    return '\n'.join(lines) + '\n'
+
+
+def b64text(field):
+    return base64.b64decode(field).decode('utf8', errors='replace')
+
+
+def parse_script_output(task, stdout):
+    """按步骤回填task.cmd、cmd_result和cmd_stderr，返回(结束码, 已完成的步骤数)"""
+    end_code = None
+    steps = 0
+    for line in str(stdout or '').splitlines():
+        fields = line.split('\t')
+        if fields[0] != SCRIPT_MARK or len(fields) < 3:
+            continue
+        if fields[1] == 'step' and len(fields) == 6:
+            task.cmd.append(b64text(fields[3]))
+            record_result(task, int(fields[2]), b64text(fields[4]), b64text(fields[5]))
+            steps += 1
+        elif fields[1] == 'var' and len(fields) == 4:
+            if fields[2] in ('device', 'uuid'):
+                setattr(task, fields[2], fields[3])
+        elif fields[1] == 'end':
+            end_code = fields[2]
+    return end_code, steps
+
+
+async def do_remote_script(conn, task):
+    """
+    通过单个exec通道执行build_remote_script生成的脚本，再按步骤回填task.cmd、cmd_result和cmd_stderr
+    """
+    script = build_remote_script(task)
+    if script is None:
+        return
+    begin = time.monotonic()
+    task.step = 'script'
+    try:
+        cmd_resp = await conn.run('/bin/sh -s', input=script, timeout=command_timeout(task, 'script'))
+    except asyncssh.TimeoutError as e:
+        # 超时前已经输出的步骤照常回填，task.cmd中最后一条之后的命令就是超时时正在执行的命令
+        steps = parse_script_output(task, e.stdout)[1]
+        task.cmd_stderr = "script timeout [%ss] after %d steps" % (command_timeout(task, 'script'), steps)
+        task.cmd_status = False
+        task.error_kind = 'timeout'
+        return
     except Exception as e:
-        task['cmd_stderr'] = str(e)
-        task['cmd_status'] = False
+        task.cmd_stderr = str(e)
+        task.cmd_status = False
+        if isinstance(e, asyncssh.ChannelOpenError):
+            task.error_kind = 'channel'
+        return
+    finally:
+        mark(task, 'script', begin)
+    end_code = parse_script_output(task, cmd_resp.stdout)[0]
+    if end_code == 'ok' or end_code == 'fail':
+        return
+    if end_code == 'route':
+        task.cmd_stderr = "cmd response is error"
+    elif end_code == 'uuid':
+        task.cmd_stderr = "get connection uuid of device %s error: %s" % (task.device, task.cmd_stderr)
+    elif end_code == 'inactive':
+        task.cmd_stderr = "connection %s is not active on any device" % (task.plan.connection or task.uuid)
+    else:
+        task.cmd_stderr = "script response is error: %s" % str(cmd_resp.stderr).strip()
+    task.cmd_status = False
+
+
+def load_journal(filename):
+    """
+    读取--journal写入的日志，返回 主机 -> (地址, 是否成功)，同一台主机以最后一条记录为准
+    运行被中断时最后一行可能不完整，无法解析的行会被跳过
+    """
+    content = read(filename)
+    if content is None:
+        return None
+    journal = {}
+    for row in content.split("\n"):
+        row = row.strip()
+        if row == "":
+            continue
+        try:
+            record = json.loads(row)
+            journal[record['host']] = (record['ip_address'], record['status'] is True)
+        except (ValueError, KeyError, TypeError):
+            logging.warning("跳过日志{}中无法解析的行：{}".format(filename, row))
+    return journal
 
 
-async def do_remote_job(task):
+class Ledger(object):
+    """
+    --ledger：SQLite地址账本，每个地址一行，记录所属的网段和主机
+    地址以16字节大端BLOB作为主键(IPv4使用::ffff:0:0/96的映射形式)，BLOB按字节比较的顺序就是地址的顺序，
+    所以一个网段的所有地址可以按主键范围查询；配置结果按批在同一个事务中写入
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS addresses (addr BLOB PRIMARY KEY, network TEXT NOT NULL, host TEXT NOT NULL, '
+        'updated REAL NOT NULL) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS addresses_host ON addresses (host, addr)',
+    )
+
+    def __init__(self, db, network, batch=256):
+        self.db = db
+        self.network = network
+        self.lower = self.key(int(network.network_address))
+        self.upper = self.key(int(network.broadcast_address))
+        self.batch = batch
+        self.pending = 0
+
+    @classmethod
+    def open(cls, filename, network):
+        """打开或创建账本，出错时返回None"""
+        import sqlite3
+        try:
+            db = sqlite3.connect(filename)
+            for sql in cls.SCHEMA:
+                db.execute(sql)
+            db.commit()
+        except sqlite3.Error as e:
+            logging.error("打开账本{}出错：{}".format(filename, e))
+            return None
+        return cls(db, network)
+
+    def key(self, value):
+        if self.network.version == 4:
+            value |= 0xffff << 32
+        return value.to_bytes(16, 'big')
+
+    def value(self, key):
+        value = int.from_bytes(key, 'big')
+        return value & 0xffffffff if self.network.version == 4 else value
+
+    def owners(self):
+        """返回网段范围内的所有(整数地址, 主机)，包括记录在其它重叠网段中的地址"""
+        rows = self.db.execute('SELECT addr, host FROM addresses WHERE addr BETWEEN ? AND ?', (self.lower, self.upper))
+        return [(self.value(addr), host) for addr, host in rows]
+
+    def add(self, task):
+        """记录配置成功的主机：--sub释放地址，--add增加地址，替换时先释放主机在该网段中原来的地址"""
+        if task.ip_value is None:
+            return
+        host = str(task.address)
+        keys = [self.key(value) for value in (task.ip_value,) + task.ip_extra]
+        if task.plan.is_sub:
+            self.db.executemany('DELETE FROM addresses WHERE addr = ? AND host = ?', [(key, host) for key in keys])
+        else:
+            if not task.plan.is_add:
+                self.db.execute('DELETE FROM addresses WHERE host = ? AND addr BETWEEN ? AND ?',
+                                (host, self.lower, self.upper))
+            now = time.time()
+            self.db.executemany('INSERT OR REPLACE INTO addresses VALUES (?, ?, ?, ?)',
+                                [(key, str(self.network), host, now) for key in keys])
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class Journal(object):
+    """
+    以JSONL格式追加记录每台主机的配置结果，每batch条或距上次落盘超过interval秒时fsync一次，关闭时全部落盘
+    没有新记录时由run()的后台任务或--workers父进程定时调用tick，运行停顿或被杀掉时最多丢失interval秒内的记录
+    """
+
+    def __init__(self, filename, batch=64, interval=1.0):
+        self.batch = batch
+        self.interval = interval
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        self.fd = open(filename, mode='a+', encoding='utf8')
+        if self.fd.tell() > 0:
+            self.fd.seek(self.fd.tell() - 1)
+            if self.fd.read(1) != '\n':
+                self.fd.write('\n')  # 上次中断时写了一半的行单独成行，不影响后面的记录
+
+    def add(self, task):
+        self.fd.write(json.dumps({
+            'host': str(task.address),
+            'ip_address': task.ip_text,
+            'status': task.cmd_status,
+        }) + '\n')
+        self.pending += 1
+        if self.pending >= self.batch or time.monotonic() - self.last_sync >= self.interval:
+            self.sync()
+
+    def tick(self):
+        if self.pending and time.monotonic() - self.last_sync >= self.interval:
+            self.sync()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.tick()
+
+    def sync(self):
+        if self.pending:
+            self.fd.flush()
+            os.fsync(self.fd.fileno())
+            self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.fd.close()
+
+
+def ssh_key(task):
+    return str(task.address), task.port, task.user
+
+
+def load_client_keys(identities):
+    """
+    启动时一次性读取并解析客户端私钥，未指定-i时读取~/.ssh下的默认私钥，返回SSHKeyPair列表
+    """
+    if identities:
+        paths = identities
+    else:
+        ssh_dir = os.path.expanduser('~/.ssh')
+        paths = [os.path.join(ssh_dir, name) for name in DEFAULT_KEY_FILES]
+        paths = [path for path in paths if os.path.exists(path)]
+    keys = []
+    for path in paths:
+        try:
+            keys.extend(asyncssh.load_keypairs(path))
+        except (OSError, asyncssh.KeyImportError) as e:
+            if identities:
+                logging.error("读取私钥%s出错：%s" % (path, e))
+                return None
+            logging.warning("跳过无法读取的私钥%s：%s" % (path, e))
+    return keys
+
+
+def load_known_hosts(filename):
+    if not filename:
+        return None
+    try:
+        return asyncssh.read_known_hosts(filename)
+    except (OSError, ValueError) as e:
+        logging.error("读取known_hosts文件%s出错：%s" % (filename, e))
+        return False
+
+
+async def connect_agent(params_parsed):
+    """
+    连接一次ssh-agent并取出全部身份，之后所有连接共用这些密钥，不再各自连接agent
+    """
+    if params_parsed['password'] is not None or params_parsed['no_agent'] or not os.environ.get('SSH_AUTH_SOCK'):
+        return None, []
+    try:
+        agent = await asyncssh.connect_agent()
+        if agent is None:
+            return None, []
+        return agent, await agent.get_keys()
+    except (OSError, asyncssh.Error) as e:
+        logging.warning("读取ssh-agent中的密钥出错：%s" % e)
+        return None, []
+
+
+def ssh_options(params_parsed, agent_keys):
+    """
+    生成所有连接共用的SSH连接选项，私钥和known_hosts都是启动时解析好的对象
+    """
     kwargs = {
-        'username': task['ssh_info']['user'],
-        'password': task['ssh_password'],
-        'port': int(task['ssh_info']['port']),
-        'known_hosts': None,
-        # 'client_keys': [],
+        'password': params_parsed['password'],
+        'known_hosts': params_parsed['known_hosts'],
+        'agent_path': None,
     }
-    if task['ssh_password']:
+    if params_parsed['password']:
         kwargs['client_keys'] = None
-    async with await asyncio.wait_for(asyncssh.connect(str(task['address']), **kwargs), timeout=15) as conn:
-        if task['test_cmd']:
-            await run_command(conn, 'uptime', task)
-            return
-        if task['connection'] is not None and task['connection'] != '':
-            nmcli_tags = task['connection']
+    else:
+        kwargs['client_keys'] = params_parsed['client_keys'] + agent_keys
+    return asyncssh.SSHClientConnectionOptions(**kwargs)
+
+
+async def open_connection(task, options):
+    """
+    建立SSH连接，由asyncssh.connect处理~/.ssh/config中的Hostname、ProxyCommand、ProxyJump等设置
+    TimingClient在TCP连接建立时记录tcp阶段，之后到连接可用为止记为auth阶段
+    """
+    begin = time.monotonic()
+    task.step = 'tcp'
+    conn = await asyncio.wait_for(
+        asyncssh.connect(str(task.address), task.port, username=task.user, options=options,
+                         client_factory=lambda: TimingClient(task, begin)),
+        timeout=task.plan.connect_timeout or None)
+    tcp_begin, tcp_spent = task.timings.get('tcp', (begin, 0.0))
+    mark(task, 'auth', tcp_begin + tcp_spent)
+    return conn
+
+
+def parse_settings(output):
+    """解析nmcli -t -f的输出，返回 字段 -> 值，值中转义的冒号和反斜杠会被还原"""
+    settings = {}
+    for line in output.splitlines():
+        name, sep, value = line.partition(':')
+        if sep:
+            settings[name.strip()] = value.replace('\\:', ':').replace('\\\\', '\\').strip()
+    return settings
+
+
+def settings_changes(task, settings):
+    """
+    比较连接当前的配置和build_modify_cmd将要写入的配置，返回不一致的字段列表
+    --add时只要求包含要增加的地址、网关和DNS，--sub时只要求不包含
+    """
+    net_type = "ipv6" if task.plan.net_type == 6 else "ipv4"
+
+    def values(name, parse):
+        items = []
+        for item in re.split(r'[,\s]+', settings.get('{}.{}'.format(net_type, name), '')):
+            if item != '' and item != '--':
+                items.append(parse(item))
+        return items
+
+    def converged(current, wanted, ordered=False):
+        if task.plan.is_add:
+            return all(item in current for item in wanted)
+        if task.plan.is_sub:
+            return not any(item in current for item in wanted)
+        return current == wanted if ordered else set(current) == set(wanted)
+
+    changes = []
+    if settings.get(net_type + '.method') != 'manual':
+        changes.append('method')
+    try:
+        if task.ip_address and not converged(values('addresses', ipaddress.ip_interface), [ipaddress.ip_interface(
+                '{}/{}'.format(addr, task.plan.ip_netmask)) for addr in task.ip_addresses]):
+            changes.append('addresses')
+        if task.plan.ip_gateway and not converged(values('gateway', ipaddress.ip_address), [task.plan.ip_gateway]):
+            changes.append('gateway')
+        if task.plan.ip_dns and not converged(values('dns', ipaddress.ip_address),
+                                              [ipaddress.ip_address(dns) for dns in task.plan.ip_dns.split()],
+                                              ordered=True):
+            changes.append('dns')
+    except ValueError:
+        changes.append('unknown')  # 无法解析当前的配置时按需要修改处理
+    if task.plan.apply_strategy != 'none' and settings.get('GENERAL.STATE') != 'activated':
+        changes.append('up')
+    return changes
+
+
+async def diff_settings(conn, task, nmcli_tags):
+    """--diff：用一条命令读取连接当前的配置，返回需要修改的字段列表，读取失败时返回None"""
+    net_type = "ipv6" if task.plan.net_type == 6 else "ipv4"
+    fields = ['{}.{}'.format(net_type, name) for name in ('method', 'addresses', 'gateway', 'dns')]
+    if task.plan.apply_strategy != 'none':
+        fields.append('GENERAL.STATE')
+    cmd = 'nmcli -t -f {} connection show "{}"'.format(','.join(fields), nmcli_tags)
+    task.cmd.append(cmd)
+    await run_command(conn, cmd, task, 'diff')
+    if task.cmd_status is False:
+        return None
+    changes = settings_changes(task, parse_settings(task.cmd_result))
+    if not changes:
+        task.unchanged = True
+    return changes
+
+
+async def do_apply(conn, task):
+    if task.plan.one_shot:
+        nmcli_tags = task.plan.connection or task.uuid
+        if task.plan.diff and nmcli_tags:
+            changes = await diff_settings(conn, task, nmcli_tags)
+            if not changes:
+                return
+            task.cmd_status = False
+        await do_remote_script(conn, task)
+        return
+    if task.plan.connection is not None and task.plan.connection != '':
+        nmcli_tags = task.plan.connection
+    elif task.uuid:
+        nmcli_tags = task.uuid  # 使用--facts-cache中缓存的连接UUID
+    else:
+        if task.device is not None and task.device != '':
+            cmd = 'nmcli device connect "{}"'.format(task.device)
         else:
-            if task['device'] is not None and task['device'] != '':
-                cmd = 'nmcli device connect "{}"'.format(task['device'])
-            else:
-                cmd = "ip route get " + tmpl_address
-                task['cmd'].append(cmd)
-                await run_command(conn, cmd, task)
-                if task['cmd_status'] is False:
-                    return
-                fields = task['cmd_result'].split()
-                if len(fields) < 5:
-                    task['cmd_stderr'] = "cmd response is error"
-                    task['cmd_status'] = False
-                    return
-                task['device'] = fields[4]
-                cmd = 'nmcli device connect "{}"'.format(task['device'])
-            task['cmd'].append(cmd)
-            await run_command(conn, cmd, task)
-            try:
-                conn_uuid = task['cmd_result'].split()[-1].strip(".").strip("'")
-            except:
-                task['cmd_stderr'] = "get connection uuid of device %s error: %s" % (task['device'], task['cmd_stderr'])
-                task['cmd_status'] = False
+            cmd = "ip route get " + tmpl_address
+            task.cmd.append(cmd)
+            await run_command(conn, cmd, task, 'route')
+            if task.cmd_status is False:
                 return
-            if not re.match(r'[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}', conn_uuid):
-                task['cmd_stderr'] = "get connection uuid of device %s  error: %s" % (
-                    task['device'], task['cmd_stderr'])
-                task['cmd_status'] = False
+            fields = task.cmd_result.split()
+            if len(fields) < 5:
+                task.cmd_stderr = "cmd response is error"
+                task.cmd_status = False
                 return
-            task['uuid'] = conn_uuid
-            nmcli_tags = conn_uuid
-        if task['net_type'] == 6:
-            net_type = "ipv6"
-        elif task['net_type'] == 4:
-            net_type = "ipv4"
-        else:
-            task['cmd_stderr'] = "unknow net type: {}".format(task['net_type'])
-            task['cmd_status'] = False
-            return
-        net_type_action = net_type
-        if task['is_add']:
-            net_type_action = "+" + net_type
-        elif task['is_sub']:
-            net_type_action = "-" + net_type
-        cmd_unfinished = [
-            f'nmcli connection modify "{nmcli_tags}" {net_type}.method manual',
-        ]
-        if task['ip_address']:
-            if task['ip_netmask']:
-                cmd_unfinished.append(
-                    '{}.addresses "{}/{}"'.format(net_type_action, str(task['ip_address']), task['ip_netmask']))
-            else:
-                cmd_unfinished.append('{}.addresses "{}"'.format(net_type_action, str(task['ip_address'])))
-        if task['ip_gateway']:
-            cmd_unfinished.append('{}.gateway "{}"'.format(net_type_action, task['ip_gateway']))
-        if task['ip_dns']:
-            cmd_unfinished.append('{}.dns "{}"'.format(net_type_action, task['ip_dns']))
-        if len(cmd_unfinished) == 1:
-            task['cmd_stderr'] = "cmd incomplete, skip"
-            task['cmd_status'] = False
-            return
-        cmd = ' '.join(cmd_unfinished)
-        task['cmd'].append(cmd)
-        await run_command(conn, cmd, task)
-        if task['cmd_status'] is False:
+            task.device = fields[4]
+            cmd = 'nmcli device connect "{}"'.format(task.device)
+        task.cmd.append(cmd)
+        await run_command(conn, cmd, task, 'device')
+        try:
+            conn_uuid = task.cmd_result.split()[-1].strip(".").strip("'")
+        except:
+            task.cmd_stderr = "get connection uuid of device %s error: %s" % (task.device, task.cmd_stderr)
+            task.cmd_status = False
             return
-        cmd = 'nmcli connection reload'
-        task['cmd'].append(cmd)
-        await run_command(conn, cmd, task)
-        if task['cmd_status'] is False:
+        if not re.match(r'[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}', conn_uuid):
+            task.cmd_stderr = "get connection uuid of device %s  error: %s" % (
+                task.device, task.cmd_stderr)
+            task.cmd_status = False
             return
-        if not task['no_up']:
+        task.uuid = conn_uuid
+        nmcli_tags = conn_uuid
+    if task.plan.diff:
+        changes = await diff_settings(conn, task, nmcli_tags)
+        if not changes:
+            return
+        if changes == ['up']:  # 配置已经一致，只需要激活连接，未激活的连接不能reapply
             cmd = 'nmcli connection up "{}"'.format(nmcli_tags)
-            task['cmd'].append(cmd)
-            await run_command(conn, cmd, task)
+            task.cmd.append(cmd)
+            await run_command(conn, cmd, task, 'up')
+            return
+    cmd = build_modify_cmd(task, nmcli_tags)
+    if cmd is None:
+        return
+    task.cmd.append(cmd)
+    await run_command(conn, cmd, task, 'modify')
+    if task.cmd_status is False:
+        return
+    await apply_changes(conn, task, nmcli_tags)
 
 
-async def task_producer(ato_task, task_queue, params_parsed):
-    for task in generate_tasks(params_parsed):
+async def apply_changes(conn, task, nmcli_tags):
+    """
+    按--apply-strategy让修改后的配置生效，整个过程的耗时记录为apply-<方式>
+    reapply需要连接已经激活的网卡，没有指定或缓存网卡时先查询连接所在的网卡
+    """
+    strategy = task.plan.apply_strategy
+    begin = time.monotonic()
+    try:
+        if strategy == 'reapply':
+            if not task.device:
+                cmd = devices_cmd(nmcli_tags)
+                task.cmd.append(cmd)
+                await run_command(conn, cmd, task, 'devices')
+                if task.cmd_status is False:
+                    return
+                task.device = task.cmd_result.strip().split(',')[0]
+                if not task.device:
+                    task.cmd_stderr = "connection %s is not active on any device" % nmcli_tags
+                    task.cmd_status = False
+                    return
+            cmd = 'nmcli device reapply "{}"'.format(task.device)
+            task.cmd.append(cmd)
+            await run_command(conn, cmd, task, 'reapply')
+            return
+        cmd = 'nmcli connection reload'
+        task.cmd.append(cmd)
+        await run_command(conn, cmd, task, 'reload')
+        if task.cmd_status is False or strategy == 'none':
+            return
+        cmd = 'nmcli connection up "{}"'.format(nmcli_tags)
+        task.cmd.append(cmd)
+        await run_command(conn, cmd, task, 'up')
+    finally:
+        mark(task, 'apply-' + strategy, begin)
+
+
+async def do_verify(conn, task):
+    """
+    配置后的校验：激活过的连接检查网卡上的实际地址，--apply-strategy none时检查连接配置中的地址
+    """
+    if not task.plan.cfg_ipaddr:
+        cmd = 'nmcli -t -f GENERAL.STATE connection show "{}"'.format(task.uuid or task.plan.connection)
+        task.cmd.append(cmd)
+        await run_command(conn, cmd, task, 'verify')
+        if task.cmd_status and 'activated' not in task.cmd_result:
+            task.cmd_stderr = "connection is not activated"
+            task.cmd_status = False
+        return
+    if task.plan.apply_strategy == 'none':
+        net_type = "ipv6" if task.plan.net_type == 6 else "ipv4"
+        cmd = 'nmcli -g {}.addresses connection show "{}"'.format(net_type, task.uuid or task.plan.connection)
+    elif task.device:
+        cmd = 'ip -o addr show dev "{}"'.format(task.device)
+    else:
+        cmd = 'ip -o addr show'
+    task.cmd.append(cmd)
+    await run_command(conn, cmd, task, 'verify')
+    if task.cmd_status is False:
+        return
+    output = task.cmd_result.replace('\\:', ':')  # nmcli -g输出的值中冒号会被转义为\:
+    for addr in task.ip_addresses:
+        found = re.search(r'(?<![\w:.]){}/{}(?![\w:.])'.format(re.escape(str(addr)), task.plan.ip_netmask),
+                          output) is not None
+        if found == task.plan.is_sub:
+            task.cmd_stderr = "address {}/{} is {}".format(
+                addr, task.plan.ip_netmask, "still present" if task.plan.is_sub else "missing")
+            task.cmd_status = False
+            return
+
+
+async def facts_stale(conn, task):
+    """
+    使用缓存的网卡和连接UUID执行失败后，用一条nmcli -g GENERAL.DEVICES检查缓存是否失效：
+    连接已经不存在或已经不在缓存的网卡上时返回True。超时和通道打开失败与缓存无关，不再检查
+    检查命令的输出不记录到任务中，任务保留原来的错误信息
+    """
+    if task.error_kind in ('timeout', 'channel'):
+        return False
+    cmd = devices_cmd(task.uuid)
+    task.cmd.append(cmd)
+    begin = time.monotonic()
+    task.step = 'facts'
+    try:
+        result = await conn.run(cmd, timeout=command_timeout(task, 'facts'))
+    except (OSError, asyncssh.Error):
+        return False
+    finally:
+        mark(task, 'facts', begin)
+    if result.returncode != 0:
+        return True
+    devices = str(result.stdout).split()
+    return bool(devices) and task.device not in devices
+
+
+async def do_remote_job(task, runtime):
+    ssh_pool = runtime['ssh_pool']
+    key = ssh_key(task)
+
+    connect_limiter = runtime['connect_limiter']
+
+    async def connect():
+        slot = None
+        if connect_limiter is not None:
+            begin = time.monotonic()
+            task.step = 'throttle'
+            slot = await connect_limiter.acquire(task.address)
+            mark(task, 'throttle', begin)
+        try:
+            begin = time.monotonic()
+            conn = await open_connection(task, runtime['options'])
+            task.connect_time = time.monotonic() - begin
+        finally:
+            if connect_limiter is not None:
+                connect_limiter.release(slot)
+        return conn
+
+    begin = time.monotonic()
+    task.step = 'acquire'
+    try:
+        conn = await ssh_pool.acquire(key, connect)
+    finally:
+        mark(task, 'acquire', begin)
+    reuse = False
+    try:
+        if task.phase == 'test':
+            await run_command(conn, 'uptime', task, 'uptime')
+        elif task.phase == 'verify':
+            await do_verify(conn, task)
+        else:
+            facts = runtime['facts']
+            cached = None
+            if facts is not None and not task.plan.connection:
+                cached = facts.get(task)
+                if cached is not None:
+                    task.device, task.uuid = cached
+            await do_apply(conn, task)
+            if cached is not None and task.cmd_status is False and await facts_stale(conn, task):
+                # 缓存的网卡或连接UUID已经失效，重新发现后再执行一次
+                facts.drop(task)
+                cached = None
+                task.device = task.plan.device
+                task.uuid = ""
+                task.error_kind = None
+                task.cmd_stderr = ""
+                task.step = None
+                await do_apply(conn, task)
+            if facts is not None and cached is None and task.cmd_status and task.uuid:
+                facts.put(task)
+        # 最后一个阶段之后没有任务再使用这个连接，立即关闭，不占用文件描述符
+        reuse = task.phase != runtime['last_phase']
+    finally:
+        await ssh_pool.release(key, conn, reuse)
+
+
+class FactsCache(object):
+    """
+    --facts-cache：按主机缓存出口网卡和连接UUID，记录超过ttl秒后失效，重新发现后更新
+    运行中只修改内存中的记录，结束时写入临时文件再替换原文件
+    """
+
+    def __init__(self, filename, ttl=86400):
+        self.filename = filename
+        self.ttl = ttl
+        self.facts = {}
+        self.updates = {}  # 本次运行中修改的记录，删除的记录为None
+        try:
+            with open(filename, encoding='utf8') as fd:
+                self.facts = json.load(fd)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning("读取缓存文件%s出错，忽略已有的缓存：%s" % (filename, e))
+        if not isinstance(self.facts, dict):
+            self.facts = {}
+
+    @staticmethod
+    def key(task):
+        return "{}:{}".format(task.address, task.port)
+
+    def get(self, task):
+        fact = self.facts.get(self.key(task))
+        if not isinstance(fact, dict) or time.time() - fact.get('time', 0) > self.ttl:
+            return None
+        if not fact.get('device') or not fact.get('uuid'):
+            return None
+        if task.plan.device and fact['device'] != task.plan.device:  # -e指定的网卡与缓存的不一致
+            return None
+        return fact['device'], fact['uuid']
+
+    def put(self, task):
+        self.facts[self.key(task)] = self.updates[self.key(task)] = {
+            'device': task.device, 'uuid': task.uuid, 'time': time.time()}
+
+    def drop(self, task):
+        self.facts.pop(self.key(task), None)
+        self.updates[self.key(task)] = None
+
+    def merge(self, updates):
+        """合并--workers子进程中修改的记录"""
+        for key, fact in updates.items():
+            if fact is None:
+                self.facts.pop(key, None)
+            else:
+                self.facts[key] = fact
+            self.updates[key] = fact
+
+    def save(self):
+        if not self.updates:
+            return
+        tmp_file = self.filename + '.tmp'
+        try:
+            with open(tmp_file, mode='w', encoding='utf8') as fd:
+                json.dump(self.facts, fd)
+            os.replace(tmp_file, self.filename)
+        except OSError as e:
+            logging.error("写入缓存文件%s出错：%s" % (self.filename, e))
+
+
+class RunStats(object):
+    """
+    汇总每台主机各阶段的耗时，运行结束时输出每个阶段的p50/p90/p99、每秒完成的主机数和最慢的主机
+    阶段耗时存放在array('d')中，最慢的主机用固定大小的堆保存；指定json_file时每台主机的原始耗时边执行边写入文件
+    """
+
+    def __init__(self, slowest=5, json_file=None):
+        self.begin = time.monotonic()
+        self.phases = {}  # 阶段 -> array('d')
+        self.counts = {}  # 任务阶段 -> [成功数, 失败数]
+        self.retries = 0
+        self.stragglers = {}  # 被--deadline取消时所处的步骤 -> 主机数
+        self.slowest_n = slowest
+        self.slowest = []  # (耗时, 序号, 主机, 任务阶段, timings) 组成的小顶堆
+        self.seq = 0
+        self.fd = None
+        if json_file:
+            self.fd = open(json_file, mode='w', encoding='utf8')
+            self.fd.write('{"hosts": [\n')
+
+    def add(self, task):
+        prefix = '' if task.phase == 'apply' else task.phase + '.'
+        for label, (_, spent) in task.timings.items():
+            self.phases.setdefault(prefix + label, array.array('d')).append(spent)
+        count = self.counts.setdefault(task.phase, [0, 0, 0])
+        count[0 if task.cmd_status else 1] += 1
+        if task.unchanged:
+            count[2] += 1
+        self.retries += max(0, task.attempts - 1)
+        if task.error_kind == 'deadline':
+            self.stragglers[task.step] = self.stragglers.get(task.step, 0) + 1
+        total = task.timings.get('total', (0, 0.0))[1]
+        self.seq += 1
+        item = (total, self.seq, str(task.address), task.phase, task.timings)
+        if len(self.slowest) < self.slowest_n:
+            heapq.heappush(self.slowest, item)
+        elif self.slowest_n and total > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+        if self.fd is not None:
+            record = {
+                'host': str(task.address),
+                'phase': task.phase,
+                'status': task.cmd_status,
+                'error': task.error_kind,
+                'attempts': task.attempts,
+                'unchanged': task.unchanged,
+                'step': task.step if not task.cmd_status else None,
+                'ip_address': task.ip_text,
+                'timings': {label: [round(start - self.begin, 6), round(spent, 6)]
+                            for label, (start, spent) in task.timings.items()},
+            }
+            self.fd.write(('' if self.seq == 1 else ',\n') + json.dumps(record))
+
+    @staticmethod
+    def percentile(values, pct):
+        return values[max(0, math.ceil(pct / 100.0 * len(values)) - 1)]
+
+    def summary(self):
+        elapsed = time.monotonic() - self.begin
+        hosts = sum(next(iter(self.counts.values()))[:2]) if self.counts else 0
+        phases = {}
+        for label, values in self.phases.items():
+            values = sorted(values)
+            phases[label] = {
+                'count': len(values),
+                'p50': self.percentile(values, 50),
+                'p90': self.percentile(values, 90),
+                'p99': self.percentile(values, 99),
+                'max': values[-1],
+            }
+        return {
+            'elapsed': elapsed,
+            'hosts': hosts,
+            'hosts_per_sec': hosts / elapsed if elapsed > 0 else 0.0,
+            'results': {phase: {'ok': ok, 'failed': failed, 'unchanged': unchanged}
+                        for phase, (ok, failed, unchanged) in self.counts.items()},
+            'retries': self.retries,
+            'deadline': dict(self.stragglers),
+            'phases': phases,
+            'slowest': [{'host': host, 'phase': phase, 'total': total}
+                        for total, _, host, phase, _ in sorted(self.slowest, reverse=True)],
+        }
+
+    def close(self):
+        """没有执行任何任务时关闭json文件，不输出报告"""
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+    def report(self):
+        summary = self.summary()
+        if self.fd is not None:
+            self.fd.write('\n], "summary": {}}}\n'.format(json.dumps(summary)))
+            self.fd.close()
+            self.fd = None
+        if not self.counts:
+            return
+        logging.warning("== performance: {} hosts in {:.2f}s, {:.1f} hosts/sec, {}{}".format(
+            summary['hosts'], summary['elapsed'], summary['hosts_per_sec'],
+            ', '.join('{} ok/failed: {}/{}{}'.format(phase, item['ok'], item['failed'], ' (unchanged: {})'.format(
+                item['unchanged']) if item['unchanged'] else '') for phase, item in summary['results'].items()),
+            ', retries: {}'.format(summary['retries']) if summary['retries'] else ''))
+        if self.stragglers:
+            logging.warning("deadline exceeded: {} hosts cancelled ({})".format(
+                sum(self.stragglers.values()),
+                ', '.join('{}: {}'.format(step, count) for step, count in
+                          sorted(self.stragglers.items(), key=lambda item: -item[1]))))
+        logging.warning("{:<16}{:>8}{:>10}{:>10}{:>10}{:>10}".format('phase', 'count', 'p50', 'p90', 'p99', 'max'))
+        for label, item in summary['phases'].items():
+            logging.warning("{:<16}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}".format(
+                label, item['count'], item['p50'], item['p90'], item['p99'], item['max']))
+        if self.slowest:
+            logging.warning("slowest hosts:")
+        for total, _, host, phase, timings in sorted(self.slowest, reverse=True):
+            logging.warning("  {:<16} {:<7} {:>8.3f}s  {}".format(host, phase, total, ' '.join(
+                '{}={:.3f}'.format(label, spent) for label, (_, spent) in timings.items() if label != 'total')))
+
+
+async def task_producer(task_queue, params_parsed, tasks, phase):
+    for task in tasks:
         if task is None:
             break
-        if params_parsed['display_ipaddr'] is True:
-            logging.warning("{} => {}".format(str(task['address']), str(task['ip_address'])))
-            continue
+        task.phase = phase
+        task.cmd_status = False
+        task.cmd_stderr = ""
+        task.timings = {}
+        task.attempts = 0
+        task.step = 'queue'
+        task.unchanged = False
+        task.enqueued = time.monotonic()
         await task_queue.put(task)
-    ato_task += 1
 
 
-async def task_customer(ato_task, ato_result, task_queue, result_queue):
+class RetryQueue(object):
+    """
+    --retries：超时、建立连接时被拒绝和通道打开失败的任务按指数退避延迟后重新放回任务队列
+    认证失败等其它错误不重试，反复登录失败可能被fail2ban或PAM锁定
+    等待中的任务保存在按到期时间排序的堆中，不占用消费者；放回任务队列之后才对上一次的任务调用task_done，
+    所以task_queue.join()会等到所有重试结束
+    """
+    RETRYABLE = ('timeout', 'refused', 'channel')
+    CONNECT_STEPS = ('throttle', 'acquire', 'tcp', 'auth')  # refused只在这些步骤中发生时才重试
+    MAX_DELAY = 30.0
+
+    def __init__(self, task_queue, retries, backoff, deadline=None):
+        self.task_queue = task_queue
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+        self.heap = []  # (到期时间, 序号, 进入等待的时间, 任务)
+        self.seq = 0
+        self.wakeup = asyncio.Event()
+
+    def schedule(self, task):
+        """任务可以重试时放入等待堆并返回True"""
+        if task.error_kind not in self.RETRYABLE or task.attempts > self.retries:
+            return False
+        if task.error_kind == 'refused' and task.step not in self.CONNECT_STEPS:
+            return False  # 执行命令时连接断开，可能已经修改了配置
+        delay = min(self.MAX_DELAY, self.backoff * 2 ** (task.attempts - 1))
+        delay = random.uniform(delay / 2, delay)
+        now = time.monotonic()
+        if self.deadline is not None and now + delay >= self.deadline:
+            return False  # 到期时已经超过--deadline，不再重试
+        self.seq += 1
+        heapq.heappush(self.heap, (now + delay, self.seq, now, task))
+        self.wakeup.set()
+        if DEBUG:
+            logging.warning("retry {} in {:.2f}s (attempt {}, {})".format(task.address, delay, task.attempts + 1,
+                                                                          task.error_kind))
+        return True
+
+    async def run(self):
+        while True:
+            if not self.heap:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            wait = self.heap[0][0] - time.monotonic()
+            if wait > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+            _, _, waited, task = heapq.heappop(self.heap)
+            now = time.monotonic()
+            task.timings['backoff'] = (waited, now - waited)
+            task.cmd_status = False
+            task.cmd_stderr = ""
+            task.step = 'queue'
+            task.enqueued = now
+            await self.task_queue.put(task)
+            self.task_queue.task_done()
+
+
+class ConnectLimiter(object):
+    """
+    限制新建SSH连接：--connect-rate按令牌桶(容量为1)控制每秒新建的连接数，--connect-subnet-max限制每个网段中同时握手的连接数
+    只在连接池需要新建连接时使用，不影响同时执行的任务数
+    """
+
+    def __init__(self, rate=0.0, subnet_max=0, subnet_prefix=24):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = 0.0  # 下一个令牌可用的时间
+        self.subnet_max = subnet_max
+        self.subnet_prefix = subnet_prefix
+        self.subnets = {}  # 网段 -> asyncio.Semaphore
+
+    async def acquire(self, address):
+        """等待网段中的握手名额和速率令牌，返回之后需要传给release的网段信号量"""
+        slot = None
+        if self.subnet_max:
+            subnet = (address.version, int(address) >> (address.max_prefixlen - self.subnet_prefix))
+            slot = self.subnets.get(subnet)
+            if slot is None:
+                slot = self.subnets[subnet] = asyncio.Semaphore(self.subnet_max)
+            await slot.acquire()
+        if self.interval:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+            if start > now:
+                try:
+                    await asyncio.sleep(start - now)
+                except BaseException:
+                    self.release(slot)
+                    raise
+        return slot
+
+    def release(self, slot):
+        if slot is not None:
+            slot.release()
+
+
+class AdaptiveLimiter(object):
+    """
+    -C auto使用的AIMD并发控制器，限制同时执行的任务数在[minimum, maximum]之间
+    - 任务成功且连接耗时没有明显变慢时加性增加：慢启动阶段每成功一个加1，之后每成功limit个加1
+    - 出现超时、连接被拒绝，或者连接耗时超过基线的LATENCY_FACTOR倍(且至少慢LATENCY_SLACK秒)时乘性减少为原来的一半
+    - 一次减少之后，在冷却时间内的其它失败不再重复减少，避免同一波失败把并发数压到最低
+    """
+    LATENCY_FACTOR = 3.0
+    LATENCY_SLACK = 0.1
+    DECREASE_FACTOR = 0.5
+
+    def __init__(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(minimum)
+        self.active = 0
+        self.slow_start = True
+        self.baseline = None  # 观察到的最小连接耗时
+        self.latency = None  # 连接耗时的指数滑动平均
+        self.last_decrease = 0.0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.cond:
+            while self.active >= int(self.limit):
+                await self.cond.wait()
+            self.active += 1
+
+    async def release(self, error_kind, connect_time):
+        async with self.cond:
+            self.active -= 1
+            self.update(error_kind, connect_time)
+            self.cond.notify_all()
+
+    def update(self, error_kind, connect_time):
+        old_limit = int(self.limit)
+        reason = None
+        if connect_time is not None:
+            self.baseline = connect_time if self.baseline is None else min(self.baseline, connect_time)
+            self.latency = connect_time if self.latency is None else self.latency * 0.8 + connect_time * 0.2
+        if error_kind in ('timeout', 'refused'):
+            reason = error_kind
+        elif self.latency is not None:
+            threshold = max(self.baseline * self.LATENCY_FACTOR, self.baseline + self.LATENCY_SLACK)
+            if self.latency > threshold:
+                reason = "latency {:.3f}s > {:.3f}s".format(self.latency, threshold)
+        now = time.monotonic()
+        if reason is not None:
+            # 冷却时间取当前平均连接耗时，至少1秒
+            if now - self.last_decrease < max(self.latency or 0.0, 1.0):
+                return
+            self.last_decrease = now
+            self.slow_start = False
+            self.limit = max(float(self.minimum), self.limit * self.DECREASE_FACTOR)
+            if self.latency is not None:
+                self.latency = self.baseline
+        elif error_kind is None:
+            self.limit = min(float(self.maximum), self.limit + (1.0 if self.slow_start else 1.0 / self.limit))
+            reason = "slow start" if self.slow_start else "additive increase"
+        if DEBUG and int(self.limit) != old_limit:
+            logging.warning("auto concurrency: {} -> {} ({}, active: {})".format(
+                old_limit, int(self.limit), reason, self.active))
+
+
+def classify_error(exc):
+    """
+    把任务异常归类：timeout(超时)、refused(拒绝或握手阶段断开，如sshd的MaxStartups)、channel(通道打开失败)、error(其它)
+    认证失败、主机密钥不匹配、密钥交换失败等DisconnectError不是服务端过载，归为error，不降低-C auto的并发数也不重试
+    """
+    if isinstance(exc, asyncio.TimeoutError):
+        return 'timeout'
+    if isinstance(exc, (ConnectionRefusedError, ConnectionResetError, asyncssh.ConnectionLost)):
+        return 'refused'
+    if isinstance(exc, asyncssh.DisconnectError) and exc.code == asyncssh.DISC_TOO_MANY_CONNECTIONS:
+        return 'refused'
+    if isinstance(exc, asyncssh.ChannelOpenError):
+        return 'channel'
+    return 'error'
+
+
+async def task_customer(task_queue, result_queue, runtime, retry_queue=None):
+    limiter = runtime['limiter']
+    journal = runtime['journal']
+    deadline = runtime['deadline']
     while True:
+        task = await task_queue.get()
+        if task is None:  # 结束标记
+            task_queue.task_done()
+            break
+        if limiter is not None:
+            await limiter.acquire()
+        begin = time.monotonic()
+        task.timings['queue'] = (task.enqueued, begin - task.enqueued)
+        task.connect_time = None
+        task.error_kind = None
+        task.attempts += 1
         try:
-            task = task_queue.get_nowait()
-        except asyncio.QueueEmpty:
-            if ato_task.value != 0:
-                break
-            await asyncio.sleep(0.1)
-            continue
-        task_queue.task_done()
-        try:
-            await do_remote_job(task)
-        except (OSError, asyncssh.Error) as exc:
-            task['cmd_stderr'] = str(exc)
-            task['cmd_status'] = False
+            async with asyncio.timeout_at(deadline):
+                if deadline is not None and begin >= deadline:
+                    raise asyncio.TimeoutError  # 截止时间之后取出的任务不再连接主机
+                await do_remote_job(task, runtime)
         except asyncio.TimeoutError as terr:
-            task['cmd_stderr'] = "coroutine wait timeout [15s]"
-            task['cmd_status'] = False
+            task.cmd_status = False
+            if deadline is not None and time.monotonic() >= deadline:
+                task.cmd_stderr = "deadline exceeded during step: %s" % task.step
+                task.error_kind = 'deadline'
+            else:
+                task.cmd_stderr = "coroutine wait timeout [%ss]" % task.plan.connect_timeout
+                task.error_kind = classify_error(terr)
+        except (OSError, asyncssh.Error) as exc:
+            task.cmd_stderr = str(exc)
+            task.cmd_status = False
+            task.error_kind = classify_error(exc)
         except Exception as e:
-            task['cmd_stderr'] = str(e)
-            task['cmd_status'] = False
+            task.cmd_stderr = str(e)
+            task.cmd_status = False
+            task.error_kind = classify_error(e)
+        finally:
+            mark(task, 'total', begin)
+            if limiter is not None:
+                await limiter.release(task.error_kind, task.connect_time)
+        if not task.cmd_status and retry_queue is not None and retry_queue.schedule(task):
+            continue  # 重试队列把任务重新放回任务队列后再调用task_done
+        if journal is not None and task.phase == 'apply':
+            journal.add(task)  # 在放入结果队列之前记录，中断时已完成的主机不会丢失
         await result_queue.put(task)
-    ato_result += 1
+        task_queue.task_done()
 
 
-async def task_display(ato_result, customer_num, result_queue):
-    global DEBUG
-    while True:
-        try:
-            result = result_queue.get_nowait()
-        except asyncio.QueueEmpty:
-            if ato_result.value == customer_num:
-                break
-            await asyncio.sleep(0.1)
-            continue
-        if DEBUG is True:
-            print("target: \033[46;37m{}\x1b[0m ".format(result['address']))
-            pprint(result)
-            continue
-        if result['cmd_status']:
-            if result['test_cmd']:
-                logging.warning(
-                    "target: \x1b[32m{}\x1b[0m, ip: \x1b[32m{}/{}\x1b[0m, status: \x1b[34m{}\x1b" +
-                    "[0m, stdout: \x1b[32m{}\x1b[0m, stderr: \x1b[91m{}\x1b[0m".format(
-                        str(result['address']),
-                        str(result['ip_address']),
-                        result['ip_netmask'],
-                        result['cmd_status'],
-                        result['cmd_result'].strip(),
-                        result['cmd_stderr'].strip(),
-                    ))
-            elif result['cfg_ipaddr']:
-                logging.warning("target: \x1b[32m{}\x1b[0m, ip: \x1b[32m{}/{}\x1b[0m, status: \x1b[34m{}\x1b[0m".format(
-                    str(result['address']),
-                    str(result['ip_address']),
-                    result['ip_netmask'],
-                    result['cmd_status'],
-                ))
-            else:
-                logging.warning("target: \x1b[32m{}\x1b[0m, status: \x1b[34m{}\x1b[0m".format(
-                    str(result['address']),
-                    result['cmd_status'],
+class ResultSink(object):
+    """
+    把结果按批写入JSONL或CSV文件，写入后清空任务中的命令列表和输出，内存占用不随主机数增长
+    """
+    FIELDS = ('host', 'phase', 'status', 'error', 'ip_address', 'device', 'uuid', 'cmd', 'stdout', 'stderr',
+              'unchanged')
+
+    def __init__(self, filename, fmt='jsonl', batch=256):
+        self.fmt = fmt
+        self.batch = batch
+        self.rows = []
+        self.fd = open(filename, mode='w', encoding='utf8', newline='')
+        self.writer = None
+        if fmt == 'csv':
+            self.writer = csv.writer(self.fd)
+            self.writer.writerow(self.FIELDS)
+
+    def add(self, task):
+        row = (
+            str(task.address),
+            task.phase,
+            task.cmd_status,
+            task.error_kind,
+            task.ip_text,
+            task.device,
+            task.uuid,
+            task.cmd,
+            task.cmd_result.strip(),
+            task.cmd_stderr.strip(),
+            task.unchanged,
+        )
+        self.rows.append(row)
+        task.cmd = []
+        task.cmd_result = ""
+        task.cmd_stderr = ""
+        if len(self.rows) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.writerows(row[:7] + ('; '.join(row[7]),) + row[8:] for row in self.rows)
+        else:
+            self.fd.write(''.join(json.dumps(dict(zip(self.FIELDS, row)), ensure_ascii=False) + '\n'
+                                  for row in self.rows))
+        self.rows.clear()
+        self.fd.flush()
+
+    def close(self):
+        self.flush()
+        self.fd.close()
+
+
+class Progress(object):
+    """
+    使用--output时控制台只显示一行实时汇总，终端中原地刷新，非终端时只在阶段结束时输出
+    """
+
+    def __init__(self, phase, interval=0.5):
+        self.phase = phase
+        self.interval = interval
+        self.begin = time.monotonic()
+        self.last = 0.0
+        self.ok = 0
+        self.failed = 0
+        self.unchanged = 0
+        self.tty = sys.stderr.isatty()
+
+    def line(self):
+        elapsed = time.monotonic() - self.begin
+        done = self.ok + self.failed
+        return "[{}] done: {}, ok: {}, failed: {}{}, {:.1f} hosts/sec".format(
+            self.phase, done, self.ok, self.failed, ', unchanged: {}'.format(self.unchanged) if self.unchanged else '',
+            done / elapsed if elapsed > 0 else 0.0)
+
+    def update(self, task):
+        if task.cmd_status:
+            self.ok += 1
+            if task.unchanged:
+                self.unchanged += 1
+        else:
+            self.failed += 1
+        now = time.monotonic()
+        if self.tty and now - self.last >= self.interval:
+            self.last = now
+            sys.stderr.write('\r' + self.line())
+            sys.stderr.flush()
+
+    def finish(self):
+        if self.ok + self.failed == 0:
+            return
+        sys.stderr.write(('\r' if self.tty else '') + self.line() + '\n')
+        sys.stderr.flush()
+
+
+def display_result(result):
+    if result.cmd_status:
+        if result.phase == 'test':
+            logging.warning(
+                ("target: \x1b[32m{}\x1b[0m, ip: \x1b[32m{}/{}\x1b[0m, status: \x1b[34m{}\x1b" +
+                 "[0m, stdout: \x1b[32m{}\x1b[0m, stderr: \x1b[91m{}\x1b[0m").format(
+                    str(result.address),
+                    result.ip_text,
+                    result.plan.ip_netmask,
+                    result.cmd_status,
+                    result.cmd_result.strip(),
+                    result.cmd_stderr.strip(),
                 ))
+        elif result.phase == 'verify':
+            logging.warning("target: \x1b[32m{}\x1b[0m, ip: \x1b[32m{}/{}\x1b[0m, verify: \x1b[34m{}\x1b[0m".format(
+                str(result.address),
+                result.ip_text,
+                result.plan.ip_netmask,
+                result.cmd_status,
+            ))
+        elif result.plan.cfg_ipaddr:
+            logging.warning("target: \x1b[32m{}\x1b[0m, ip: \x1b[32m{}/{}\x1b[0m, status: \x1b[34m{}\x1b[0m".format(
+                str(result.address),
+                result.ip_text,
+                result.plan.ip_netmask,
+                'unchanged' if result.unchanged else result.cmd_status,
+            ))
         else:
-            logging.warning("target: \x1b[32m{}\x1b[0m, status: \x1b[33m{}\x1b[0m, error: \x1b[91m{}\x1b[0m".format(
-                str(result['address']),
-                result['cmd_status'],
-                result['cmd_stderr'].strip(),
+            logging.warning("target: \x1b[32m{}\x1b[0m, status: \x1b[34m{}\x1b[0m".format(
+                str(result.address),
+                'unchanged' if result.unchanged else result.cmd_status,
             ))
+    else:
+        logging.warning("target: \x1b[32m{}\x1b[0m, {}: \x1b[33m{}\x1b[0m, error: \x1b[91m{}\x1b[0m".format(
+            str(result.address),
+            "verify" if result.phase == 'verify' else "status",
+            result.cmd_status,
+            result.cmd_stderr.strip(),
+        ))
+
+
+def show_result(result, runtime, progress):
+    global DEBUG
+    runtime['stats'].add(result)
+    if runtime['ledger'] is not None and result.phase == 'apply' and result.cmd_status:
+        runtime['ledger'].add(result)
+    if DEBUG is True:
+        from pprint import pprint
+        print("target: \033[46;37m{}\x1b[0m ".format(result.address))
+        pprint(result.as_dict())
+    if runtime['sink'] is not None:
+        runtime['sink'].add(result)
+        progress.update(result)
+    elif DEBUG is not True:
+        display_result(result)
+
+
+async def task_display(result_queue, passed, runtime, phase):
+    forward = runtime['forward']
+    progress = Progress(phase) if runtime['sink'] is not None else None
+    while True:
+        result = await result_queue.get()
+        if result is None:  # 结束标记
+            result_queue.task_done()
+            break
+        if passed is not None and result.cmd_status:
+            passed.append(result)
+        if forward is not None:
+            forward.send(('result', result))  # --workers的子进程把结果交给父进程显示和汇总
+        else:
+            show_result(result, runtime, progress)
         result_queue.task_done()
+    if progress is not None:
+        progress.finish()
 
 
-async def work(loop, params_parsed, customer_num: uint8):
+async def work(params_parsed, runtime, phase='apply', tasks=None, collect=False):
+    """
+    生产者、消费者和显示协程都阻塞在队列上，有数据时立即处理，不再轮询
+    生产完成后等待任务队列清空，再给每个消费者发送结束标记；消费者全部退出后给显示协程发送结束标记
+    collect为True时返回本阶段执行成功的任务列表，供下一个阶段使用
+    """
     task_queue = asyncio.Queue(maxsize=100)
     result_queue = asyncio.Queue(maxsize=100)
+    if tasks is None:
+        tasks = generate_tasks(params_parsed)
+    passed = [] if collect else None
+    retry_queue = RetryQueue(task_queue, params_parsed['retries'], params_parsed['retry_backoff'],
+                             runtime['deadline']) if params_parsed['retries'] else None
+
+    async with asyncio.TaskGroup() as group:
+        group.create_task(task_display(result_queue, passed, runtime, phase))
+        async with asyncio.TaskGroup() as customers:
+            for _ in range(runtime['customer_num']):
+                customers.create_task(task_customer(task_queue, result_queue, runtime, retry_queue))
+            if retry_queue is not None:
+                scheduler = customers.create_task(retry_queue.run())
+            await task_producer(task_queue, params_parsed, tasks, phase)
+            await task_queue.join()
+            if retry_queue is not None:
+                scheduler.cancel()
+            for _ in range(runtime['customer_num']):
+                await task_queue.put(None)
+        await result_queue.put(None)
+    return passed
+
+
+def display_addresses(params_parsed):
+    """-I：只输出地址池中的主机与生成的地址的对应关系，不需要事件循环和SSH"""
+    for task in generate_tasks(params_parsed):
+        if task is None:
+            break
+        logging.warning("{} => {}".format(str(task.address), task.ip_text))
 
-    ato_task = AtomicLong(0)
-    ato_result = AtomicLong(0)
-
-    coroutines = [loop.create_task(task_producer(ato_task, task_queue, params_parsed))]
-
-    for _ in range(customer_num):
-        coroutines.append(loop.create_task(task_customer(ato_task, ato_result, task_queue, result_queue)))
-    coroutines.append(loop.create_task(task_display(ato_result, customer_num, result_queue)))
-
-    done, pending = await asyncio.wait(coroutines, return_when=asyncio.FIRST_EXCEPTION)
-    for d in done:
-        if d.exception():
-            d.print_stack()
-    for p in pending:
-        p.cancel()
-
-
-def sorted_ipaddres(sorted_file):
-    content = read(sorted_file)
-    if not content:
-        return content
-    ipv4 = {}
-    ipv6 = {}
-    addrs_like = re.findall(
-        r"(?<![:.\w])(?:[a-f0-9]{1,4}:){7}[a-f0-9]{1,4}(?![:.\w])|(?<![.\d])(?:\d{1,3}\.){3}\d{1,3}(?![.\d])",
-        content, re.I)
-    for addr_like in addrs_like:
-        ip_parsed = check_ipaddr(addr_like.strip())
-        if not ip_parsed:
+
+def open_outputs(params_parsed):
+    """打开性能统计、结果文件、日志文件和账本，出错时关闭已经打开的文件并返回None"""
+    stats = sink = journal = None
+    try:
+        stats = RunStats(params_parsed['slowest'], params_parsed['stats_json'])
+        sink = ResultSink(params_parsed['output'], params_parsed['format']) if params_parsed['output'] else None
+        journal = Journal(params_parsed['journal']) if params_parsed['journal'] else None
+    except OSError as e:
+        logging.error("打开输出文件出错：%s" % e)
+    else:
+        ledger = None
+        if params_parsed['ledger']:
+            ledger = Ledger.open(params_parsed['ledger'], params_parsed['network'])
+        if ledger is not None or not params_parsed['ledger']:
+            return stats, sink, journal, ledger
+    for output in (stats, sink, journal):
+        if output is not None:
+            output.close()
+    return None
+
+
+async def run(params_parsed, forward=None):
+    """
+    依次执行探测、配置和校验阶段，各阶段通过同一个连接池复用到每台主机的SSH连接
+    forward为--workers子进程到父进程的管道，结果、日志和性能统计都由父进程处理
+    无法导入asyncssh或打开输出文件时返回False
+    """
+    if not import_ssh():
+        return False
+    if forward is not None:
+        stats, sink, journal, ledger = None, None, None, None
+    else:
+        outputs = open_outputs(params_parsed)
+        if outputs is None:
+            return False
+        stats, sink, journal, ledger = outputs
+    conn_max = params_parsed['conn_max']
+    if conn_max is None:
+        conn_max = default_conn_max()
+    ssh_pool = SSHConnPool(conn_max, params_parsed['conn_idle'])
+    facts = FactsCache(params_parsed['facts_cache'], params_parsed['facts_ttl']) if params_parsed['facts_cache'] else None
+    agent, agent_keys = await connect_agent(params_parsed)
+    runtime = {
+        'ssh_pool': ssh_pool,
+        'options': ssh_options(params_parsed, agent_keys),
+        'customer_num': params_parsed['concurrency'],
+        'limiter': None,
+        'connect_limiter': None,
+        'stats': stats,
+        'sink': sink,
+        'journal': journal,
+        'ledger': ledger,
+        'facts': facts,
+        'forward': forward,
+        'deadline': time.monotonic() + params_parsed['deadline'] if params_parsed['deadline'] else None,
+        'last_phase': 'test' if params_parsed['test_cmd'] else 'verify' if params_parsed['verify'] else 'apply',
+    }
+    if params_parsed['connect_rate'] or params_parsed['connect_subnet_max']:
+        runtime['connect_limiter'] = ConnectLimiter(params_parsed['connect_rate'], params_parsed['connect_subnet_max'],
+                                                    params_parsed['connect_subnet_prefix'])
+    if params_parsed['auto_concurrency']:
+        runtime['customer_num'] = params_parsed['max_concurrency']
+        runtime['limiter'] = AdaptiveLimiter(params_parsed['min_concurrency'], params_parsed['max_concurrency'])
+    syncer = asyncio.create_task(journal.run()) if journal is not None else None
+    try:
+        if params_parsed['test_cmd']:
+            await work(params_parsed, runtime, 'test')
+            return
+        tasks = None
+        if params_parsed['precheck']:
+            tasks = await work(params_parsed, runtime, 'test', collect=True)
+        tasks = await work(params_parsed, runtime, 'apply', tasks, collect=params_parsed['verify'])
+        if params_parsed['verify']:
+            await work(params_parsed, runtime, 'verify', tasks)
+    finally:
+        if syncer is not None:
+            syncer.cancel()
+        if sink is not None:
+            sink.close()
+        if journal is not None:
+            journal.close()
+        if ledger is not None:
+            ledger.close()
+        if facts is not None:
+            if forward is not None:
+                forward.send(('facts', facts.updates))
+            else:
+                facts.save()
+        if stats is not None:
+            stats.report()
+        await ssh_pool.close()
+        if agent is not None:
+            agent.close()
+            await agent.wait_closed()
+        if DEBUG:
+            logging.warning("ssh handshakes: {}".format(ssh_pool.handshakes))
+
+
+def run_worker(params_parsed, worker, writer):
+    """
+    --workers的子进程：在分片中再按序号分出第worker份，使用自己的事件循环执行，结果通过writer发回父进程
+    """
+    workers = params_parsed['workers']
+    shard_index, shard_count = params_parsed['shard']
+
+    def share(value):
+        return max(1, value // workers)
+
+    params_parsed = dict(params_parsed)
+    params_parsed['shard'] = (shard_index + shard_count * worker, shard_count * workers)
+    params_parsed['concurrency'] = share(params_parsed['concurrency'])
+    params_parsed['max_concurrency'] = share(params_parsed['max_concurrency'])
+    params_parsed['min_concurrency'] = min(share(params_parsed['min_concurrency']), params_parsed['max_concurrency'])
+    if params_parsed['conn_max']:
+        params_parsed['conn_max'] = share(params_parsed['conn_max'])
+    if params_parsed['connect_subnet_max']:
+        params_parsed['connect_subnet_max'] = share(params_parsed['connect_subnet_max'])
+    params_parsed['connect_rate'] = params_parsed['connect_rate'] / workers
+    code = 0
+    try:
+        with asyncio.Runner() as runner:
+            if runner.run(run(params_parsed, writer)) is False:
+                code = 1
+    except KeyboardInterrupt:
+        code = 1
+    except Exception as e:
+        logging.error("asyncio error: %s" % e)
+        code = 1
+    finally:
+        writer.close()
+    sys.exit(code)
+
+
+def run_workers(params_parsed):
+    """
+    --workers：启动多个子进程分担主机，所有子进程使用同一个完整的地址分配计划
+    父进程从管道接收结果，统一显示、写入结果文件和日志，并输出合并后的性能报告
+    """
+    import multiprocessing
+    import multiprocessing.connection
+    outputs = open_outputs(params_parsed)
+    if outputs is None:
+        return False
+    stats, sink, journal, ledger = outputs
+    facts = FactsCache(params_parsed['facts_cache'], params_parsed['facts_ttl']) if params_parsed['facts_cache'] else None
+    runtime = {'stats': stats, 'sink': sink, 'ledger': ledger}
+    context = multiprocessing.get_context('fork')
+    procs = []
+    readers = []
+    for worker in range(params_parsed['workers']):
+        reader, writer = context.Pipe(duplex=False)
+        proc = context.Process(target=run_worker, args=(params_parsed, worker, writer))
+        proc.start()
+        writer.close()
+        procs.append(proc)
+        readers.append(reader)
+    # Ctrl-C由子进程处理，父进程继续接收已经完成的结果，等待子进程退出
+    interrupted = []
+    old_handler = signal.signal(signal.SIGINT, lambda signum, frame: interrupted.append(signum))
+    progress = {}
+    try:
+        while readers:
+            ready = multiprocessing.connection.wait(readers, journal.interval if journal is not None else None)
+            if journal is not None:
+                journal.tick()
+            for reader in ready:
+                try:
+                    kind, payload = reader.recv()
+                except EOFError:
+                    readers.remove(reader)
+                    continue
+                if kind == 'facts':
+                    if facts is not None:
+                        facts.merge(payload)
+                    continue
+                if journal is not None and payload.phase == 'apply':
+                    journal.add(payload)
+                if sink is not None and payload.phase not in progress:
+                    progress[payload.phase] = Progress(payload.phase)
+                show_result(payload, runtime, progress.get(payload.phase))
+        for proc in procs:
+            proc.join()
+    finally:
+        signal.signal(signal.SIGINT, old_handler)
+        for item in progress.values():
+            item.finish()
+        if sink is not None:
+            sink.close()
+        if journal is not None:
+            journal.close()
+        if ledger is not None:
+            ledger.close()
+        if facts is not None:
+            facts.save()
+        stats.report()
+    if interrupted:
+        logging.error("运行被中断")
+        return False
+    return all(proc.exitcode == 0 for proc in procs)
+
+
+def sort_chunks(buf, size, chunk_size=SORT_CHUNK):
+    """
+    把文件切分为约chunk_size大小的块，边界向后移动到第一个不在SORT_CONTEXT中的字节，没有地址会跨越两个块
+    """
+    start = 0
+    while start < size:
+        end = min(start + chunk_size, size)
+        while end < size and buf[end] in SORT_CONTEXT:
+            end += 1
+        yield start, end
+        start = end
+
+
+def scan_addresses(buf, start, end):
+    """
+    扫描buf[start:end]中的地址，返回(IPv4整数集合, IPv6整数集合)
+    在整个buf上从start开始匹配，前向断言可以看到块之前的内容
+    """
+    ipv4 = set()
+    ipv6 = set()
+    for addr_v6, addr_v4 in set(SORT_PATTERN.findall(buf, start, end)):
+        try:
+            if addr_v4:
+                ipv4.add(int.from_bytes(socket.inet_pton(socket.AF_INET, addr_v4.decode()), 'big'))
+            else:
+                ipv6.add(int.from_bytes(socket.inet_pton(socket.AF_INET6, addr_v6.decode()), 'big'))
+        except OSError:
             continue
-        if ip_parsed.version == 4:
-            ipv4[str(ip_parsed)] = ip_parsed
-        elif ip_parsed.version == 6:
-            ipv6[str(ip_parsed)] = ip_parsed
-
-    ipv4_merge = []
-    ipv6_merge = []
-    for _, ip_parsed in ipv4.items():
-        ipv4_merge.append(ip_parsed)
-    for _, ip_parsed in ipv6.items():
-        ipv6_merge.append(ip_parsed)
-    ipv4_sorted = sorted(ipv4_merge)
-    ipv6_sorted = sorted(ipv6_merge)
-    for ip_parsed in ipv4_sorted:
-        print(str(ip_parsed))
-    for ip_parsed in ipv6_sorted:
-        print(str(ip_parsed))
+    return ipv4, ipv6
+
+
+def scan_file_chunk(filename, start, end):
+    """--sort-jobs大于1时在子进程中执行，每个进程各自mmap文件"""
+    with open(filename, mode='rb') as fd:
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return scan_addresses(buf, start, end)
+
+
+def format_ipv6(value):
+    text = socket.inet_ntop(socket.AF_INET6, value.to_bytes(16, 'big'))
+    if '.' in text:  # inet_ntop把IPv4映射地址写成::ffff:1.2.3.4，与ipaddress的格式保持一致
+        text = str(ipaddress.IPv6Address(value))
+    return text
+
+
+def sorted_ipaddres(sorted_file, jobs=1):
+    ipv4 = set()
+    ipv6 = set()
+    try:
+        with open(sorted_file, mode='rb') as fd:
+            size = os.fstat(fd.fileno()).st_size
+            if size == 0:
+                return None
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                chunks = sort_chunks(buf, size)
+                if jobs > 1:
+                    import concurrent.futures
+                    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+                        futures = [executor.submit(scan_file_chunk, sorted_file, start, end) for start, end in chunks]
+                        for future in futures:
+                            chunk_v4, chunk_v6 = future.result()
+                            ipv4 |= chunk_v4
+                            ipv6 |= chunk_v6
+                else:
+                    for start, end in chunks:
+                        chunk_v4, chunk_v6 = scan_addresses(buf, start, end)
+                        ipv4 |= chunk_v4
+                        ipv6 |= chunk_v6
+    except (OSError, ValueError) as e:
+        logging.error("文件打开出错：%s" % e)
+        return None
+
+    out = sys.stdout
+    ipv4_sorted = sorted(ipv4)
+    del ipv4
+    for index in range(0, len(ipv4_sorted), ALLOC_BATCH):
+        out.write(''.join(socket.inet_ntop(socket.AF_INET, value.to_bytes(4, 'big')) + '\n'
+                          for value in ipv4_sorted[index:index + ALLOC_BATCH]))
+    del ipv4_sorted
+    ipv6_sorted = sorted(ipv6)
+    del ipv6
+    for index in range(0, len(ipv6_sorted), ALLOC_BATCH):
+        out.write(''.join(format_ipv6(value) + '\n' for value in ipv6_sorted[index:index + ALLOC_BATCH]))
+    out.flush()
     return True
 
 
@@ -847,18 +3068,30 @@ def do():
         args.func()
         return True
     if args.sort:
-        return sorted_ipaddres(args.sort)
+        if args.sort_jobs < 1:
+            logging.error("--sort-jobs必须大于等于1")
+            return
+        return sorted_ipaddres(args.sort, args.sort_jobs)
     params_parsed = parsed_params(args)
     if not params_parsed:
         return
-    event_loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(event_loop)
+    if params_parsed['display_ipaddr']:
+        display_addresses(params_parsed)
+        return True
+    if params_parsed['workers'] > 1:
+        if not run_workers(params_parsed):
+            return
+        return True
+    # Ctrl-C时asyncio.Runner会取消run()，让结果文件和日志在退出前落盘
     try:
-        event_loop.run_until_complete(work(event_loop, params_parsed, args.concurrency))
+        with asyncio.Runner() as runner:
+            if runner.run(run(params_parsed)) is False:
+                return
+    except KeyboardInterrupt:
+        logging.error("运行被中断")
+        return
     except Exception as e:
         logging.error("asyncio error: %s" % e)
-    finally:
-        event_loop.close()
     return True
 
 